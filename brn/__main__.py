@@ -1,10 +1,16 @@
 import argparse
+import getpass
 import json
 import os
 
 from . import interrupt
-from .client import create_job, download_results
+from .aserver import AsyncServer
+from .bench import DEFAULTS as BENCH_DEFAULTS, bench
+from .client import create_job, download_results, show_metrics
+from .scheduler import SCHEDULERS, make_scheduler
 from .server import Server
+from .shard import serve as serve_sharded
+from .storage import FORMATS
 from .worker import run_worker
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -24,35 +30,80 @@ def create_config():
 def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest="mode", required=True)
-    subparsers.add_parser("server")
-    subparsers.add_parser("worker")
+    server_parser = subparsers.add_parser("server")
+    server_parser.add_argument("--asyncio", action="store_true", help="Serve all connections on one asyncio event loop.")
+    server_parser.add_argument("--scheduler", choices=list(SCHEDULERS), default="priority", help="Job scheduling policy.")
+    server_parser.add_argument("--no-affinity", action="store_true", help="Don't prefer jobs whose blend a worker has cached.")
+    server_parser.add_argument("--root", type=str, default=None, help="Data directory, kept across restarts.")
+    server_parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics over HTTP on this port.")
+    server_parser.add_argument("--procs", type=int, default=1, help="Serve from this many processes, each owning a share of the jobs.")
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument("--slots", type=int, default=1, help="Number of concurrent render processes.")
+    worker_parser.add_argument("--threads", type=int, default=0, help="Render threads per slot.")
+    worker_parser.add_argument("--pin", action="store_true", help="Pin each slot to its own CPUs.")
     subparsers.add_parser("config")
     create_parser = subparsers.add_parser("create")
     create_parser.add_argument("blend", type=str)
     create_parser.add_argument("frames", type=str, help="Python slice format i.e. a:b:c,d:e, etc.")
+    create_parser.add_argument("--priority", type=int, default=0, help="Higher priority jobs are rendered first.")
+    create_parser.add_argument("--user", type=str, default=getpass.getuser(), help="User for fair share scheduling.")
+    create_parser.add_argument("--deadline", type=float, default=None, help="Minutes from now, for deadline scheduling.")
+    create_parser.add_argument("--tiles", type=int, default=1, help="Split each frame into tiles rendered by different workers.")
+    create_parser.add_argument("--format", choices=list(FORMATS), default="JPEG", help="Output image format.")
+    create_parser.add_argument("--packed", action="store_true", help="Store renders on the server in a few large files.")
     download_parser = subparsers.add_parser("download")
     download_parser.add_argument("job_id", type=str)
     download_parser.add_argument("outdir", type=str)
+    metrics_parser = subparsers.add_parser("metrics")
+    metrics_parser.add_argument("--json", action="store_true", help="Print as JSON instead of Prometheus text.")
+    bench_parser = subparsers.add_parser("bench", help="Load test an in-process server with simulated workers.")
+    bench_parser.add_argument("--workers", type=int, help=f"Simulated workers. Default {BENCH_DEFAULTS['workers']}.")
+    bench_parser.add_argument("--procs", type=int, help="Processes to run the workers in. Default: CPU count, at most 8.")
+    bench_parser.add_argument("--jobs", type=int, help=f"Jobs to create. Default {BENCH_DEFAULTS['jobs']}.")
+    bench_parser.add_argument("--frames", type=int, help=f"Frames per job. Default {BENCH_DEFAULTS['frames']}.")
+    bench_parser.add_argument("--frame-time", type=float, help=f"Mean render time per frame (sec). Default {BENCH_DEFAULTS['frame_time']}.")
+    bench_parser.add_argument("--jitter", type=float, help=f"Standard deviation of frame time, relative to the mean. Default {BENCH_DEFAULTS['jitter']}.")
+    bench_parser.add_argument("--speed-spread", type=float, help=f"Worker speeds vary by up to this fraction. Default {BENCH_DEFAULTS['speed_spread']}.")
+    bench_parser.add_argument("--output-size", type=int, help=f"Bytes per rendered frame. Default {BENCH_DEFAULTS['output_size']}.")
+    bench_parser.add_argument("--asyncio", action="store_true", default=None, help="Benchmark the asyncio server.")
+    bench_parser.add_argument("--scheduler", choices=list(SCHEDULERS), help="Job scheduling policy.")
+    bench_parser.add_argument("--seed", type=int, help="Seed for frame times and worker speeds.")
+    bench_parser.add_argument("--timeout", type=float, help=f"Give up after this many seconds. Default {BENCH_DEFAULTS['timeout']}.")
+    bench_parser.add_argument("--json", action="store_true", help="Print report as JSON.")
     args = parser.parse_args()
 
+    if args.mode == "bench":
+        bench(args)
+        return
+
     if not os.path.isfile(CONFIG_PATH) or args.mode == "config":
         create_config()
 
     with open(CONFIG_PATH) as f:
         config = json.load(f)
 
-    if args.mode == "server":
-        server = Server(config["ip"], config["port"])
+    if args.mode == "server" and args.procs > 1:
+        interrupt.register()
+        serve_sharded(AsyncServer if args.asyncio else Server, config["ip"], config["port"], args.procs,
+            args.scheduler, not args.no_affinity, args.root, args.metrics_port)
+    elif args.mode == "server":
+        server_cls = AsyncServer if args.asyncio else Server
+        scheduler = make_scheduler(args.scheduler, not args.no_affinity)
+        server = server_cls(config["ip"], config["port"], scheduler, args.root)
         interrupt.register(server)
+        if args.metrics_port is not None:
+            server.serve_metrics(args.metrics_port)
         server.start()
     else:
         interrupt.register()
         if args.mode == "worker":
-            run_worker(config)
+            run_worker(config, args.slots, args.threads, args.pin)
         elif args.mode == "create":
             create_job(config, args)
         elif args.mode == "download":
             download_results(config, args)
+        elif args.mode == "metrics":
+            show_metrics(config, args)
 
 
 if __name__ == "__main__":
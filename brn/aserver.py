@@ -0,0 +1,248 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcon
+
+from .conn import HEADER, VERSION, FLAG_RAW, CHUNK_SIZE
+from .server import Server, remove_temp_file
+
+
+def payload_size(obj):
+    """
+    Bytes of binary data in a response, e.g. "data" or the values of "renders".
+    Cheap estimate of its encoded size, to decide where to encode it.
+    """
+    size = 0
+    for value in obj.values():
+        if isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        elif isinstance(value, dict):
+            size += sum(len(v) for v in value.values() if isinstance(v, (bytes, bytearray)))
+    return size
+
+
+class AsyncServer(Server):
+    """
+    Server running on one asyncio event loop instead of a thread per connection.
+    Serves the same requests (see `Server`) through `handle_request`, which runs
+    on a bounded thread pool since it does blocking disk I/O.
+
+    Backpressure: at most `max_inflight` requests are processed at once; other
+    connections wait for a slot before their request is decoded, and responses
+    wait for the socket to drain before the next request is read.
+    """
+
+    max_connections = 10000
+    max_inflight = 64
+    # Requests to other shards at once. Forwarded long polls hold one while they wait.
+    max_forwards = 256
+    # Decode and encode messages larger than this on the executor instead of the loop (bytes).
+    large_message = 2**16
+
+    def __init__(self, ip, port, scheduler=None, root=None, shard=None):
+        super().__init__(ip, port, scheduler, root, shard)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_inflight)
+        # Requests forwarded to another shard may wait there for a long poll; kept off `executor`.
+        self.forward_executor = ThreadPoolExecutor(max_workers=self.max_forwards)
+        self.loop = None
+        self.server = None
+        self.peer_server = None
+
+    def start(self):
+        """
+        Holds forever.
+        """
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """
+        Stops the server. Safe to call from a signal handler or another thread.
+        """
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            if self.peer_server is not None:
+                self.loop.call_soon_threadsafe(self.peer_server.close)
+        else:
+            self.sock.close()
+            if self.peer_sock is not None:
+                self.peer_sock.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.conn_slots = asyncio.Semaphore(self.max_connections)
+        self.request_slots = asyncio.Semaphore(self.max_inflight)
+
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        self.server = await asyncio.start_server(self.handle_client_async, sock=self.sock)
+        if self.peer_sock is not None:
+            self.peer_sock.listen(1024)
+            self.peer_sock.setblocking(False)
+            self.peer_server = await asyncio.start_unix_server(self.handle_client_async, sock=self.peer_sock)
+        print(f"Server listening (asyncio)")
+
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.peer_server is not None:
+                self.peer_server.close()
+            self.executor.shutdown(wait=False)
+            self.forward_executor.shutdown(wait=False)
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def run_forward(self, func, *args):
+        """
+        Run a request to other shards. Never holds a request slot: the other shard may be
+        waiting for a slot here at the same time.
+        """
+        return await self.loop.run_in_executor(self.forward_executor, func, *args)
+
+    async def get_work_async(self, request, addr):
+        """
+        Async counterpart of `Server.get_work`; only the local steps take a request slot.
+        """
+        response = wait = None
+        for step, peer in self.work_steps(request):
+            if peer:
+                response = await self.run_forward(self.peer_work, request, step == "speculate") or response
+            else:
+                async with self.request_slots:
+                    response = await self.run_blocking(self.handle_request, {**request, "_step": step}, addr)
+                wait = wait or response.get("_wait")
+            if response["status"] != "no_work":
+                return response
+        response["_wait"] = wait
+        return response
+
+    async def handle_client_async(self, reader, writer):
+        """
+        Serve requests on one connection until the client closes it.
+        """
+        addr = writer.get_extra_info("peername")
+        async with self.conn_slots:
+            try:
+                while True:
+                    try:
+                        header = await asyncio.wait_for(reader.readexactly(HEADER.size), self.idle_timeout)
+                        version, flags, length = HEADER.unpack(header)
+                        if version != VERSION or flags != 0:
+                            break
+                        data = await reader.readexactly(length)
+                    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                        break
+
+                    self.manager.metrics.add_bytes(bytes_in=HEADER.size + length)
+                    async with self.request_slots:
+                        if length > self.large_message:
+                            request = await self.run_blocking(bcon.loads, data)
+                        else:
+                            request = bcon.loads(data)
+                        del data
+
+                        if not isinstance(request, dict) or "method" not in request:
+                            print(f"Invalid request from {addr}")
+                            break
+                        print(f"Request from {addr}; method={request['method']}")
+
+                    response = await self.respond_async(request, addr)
+                    file = self.take_file(request, response)
+                    if "id" in request:
+                        response["id"] = request["id"]
+                    t = time.perf_counter()
+                    size = await self.send_async(writer, response)
+                    if file is not None:
+                        path, offset, temporary = file
+                        try:
+                            size += await self.send_file_async(writer, path, offset)
+                        finally:
+                            if temporary:
+                                remove_temp_file(path)
+                    self.manager.metrics.observe_phase("send", time.perf_counter() - t)
+                    self.manager.metrics.add_bytes(bytes_out=size)
+
+            except ConnectionError:
+                pass
+            except asyncio.CancelledError:
+                # Server stopped while the connection was open.
+                pass
+            finally:
+                writer.close()
+
+    async def respond_async(self, request, addr):
+        """
+        Async counterpart of `Server.respond`. Long-poll requests wait on the
+        event loop, so they don't hold a request slot or an executor thread.
+        Latency metrics include waiting for a request slot.
+        """
+        shard = self.route(request)
+        if shard is not None:
+            return await self.run_forward(self.forward, shard, request)
+
+        metrics = self.manager.metrics
+        deadline = time.monotonic() + min(request.get("wait", 0), self.max_wait)
+        elapsed = 0
+        metrics.add_in_flight(1)
+        try:
+            while True:
+                t = time.perf_counter()
+                if request["method"] == "get_work":
+                    response = await self.get_work_async(request, addr)
+                else:
+                    async with self.request_slots:
+                        response = await self.run_blocking(self.handle_request, request, addr)
+                if response.pop("_announce", False):
+                    await self.run_forward(self.announce_work)
+                elapsed += time.perf_counter() - t
+                wait = response.pop("_wait", None)
+                remaining = deadline - time.monotonic()
+                if wait is None or remaining <= 0:
+                    metrics.observe_request(self.metric_name(request, response), elapsed)
+                    return response
+                if "_file" in response and response["_file"][2]:
+                    remove_temp_file(response["_file"][0])
+                notifier, version = wait
+                metrics.add_waiting(1)
+                try:
+                    await notifier.wait_async(version, min(remaining, self.poll_interval))
+                finally:
+                    metrics.add_waiting(-1)
+        finally:
+            metrics.add_in_flight(-1)
+
+    async def send_async(self, writer, obj):
+        """
+        :return: Bytes sent.
+        """
+        if payload_size(obj) > self.large_message:
+            async with self.request_slots:
+                data = await self.run_blocking(bcon.dumps, obj)
+        else:
+            data = bcon.dumps(obj)
+        writer.write(HEADER.pack(VERSION, 0, len(data)))
+        writer.write(data)
+        await writer.drain()
+        return HEADER.size + len(data)
+
+    async def send_file_async(self, writer, path, start=0):
+        """
+        Async counterpart of `conn.send_file`.
+        :return: Bytes sent.
+        """
+        sent = 0
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = start * CHUNK_SIZE
+            while offset < size:
+                length = min(CHUNK_SIZE, size - offset)
+                writer.write(HEADER.pack(VERSION, FLAG_RAW, length))
+                await writer.drain()
+                await self.loop.sendfile(writer.transport, f, offset, length)
+                offset += length
+                sent += HEADER.size + length
+        return sent
@@ -0,0 +1,281 @@
+"""
+Load test: a server in this process, driven by simulated workers.
+
+Workers don't run Blender: a stub renderer sleeps for each frame's render time
+and returns random bytes of the configured size. Render times are derived from
+the seed, so runs with the same options do the same work.
+
+Workers run as threads in child processes, so they don't compete with the
+server for the GIL, and this process's CPU and memory use is the server's.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from threading import Thread
+
+from .aserver import AsyncServer
+from .conn import make_request
+from .frameset import FrameSet, decode
+from .scheduler import make_scheduler
+from .server import Server
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Seconds a worker sends status updates after, like `worker.Slot`.
+STATUS_UPDATE_INTERVAL = 5
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def frame_time(opts, job_id, frame):
+    """
+    Render time of a frame on a worker of speed 1.
+    """
+    rng = random.Random(f"{opts['seed']}:{job_id}:{frame}")
+    return max(0, rng.gauss(opts["frame_time"], opts["frame_time"] * opts["jitter"]))
+
+
+def stub_render(seconds, payload, frame):
+    """
+    Stand-in for Blender: wait, then return image data of len(payload) bytes.
+    """
+    time.sleep(seconds)
+    prefix = f"{frame}:".encode()
+    return prefix + payload[len(prefix):]
+
+
+class Recorder:
+    """
+    Client-side latency samples of one worker thread: {method: [seconds, ...]}.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.samples = {}
+
+    def request(self, data):
+        t = time.perf_counter()
+        response = make_request(self.config, data)
+        seconds = time.perf_counter() - t
+
+        name = data["method"]
+        if response["status"] == "no_work":
+            # Held by the server until its wait ran out; kept apart from get_work latency.
+            name += "_empty"
+        self.samples.setdefault(name, []).append(seconds)
+        return response
+
+
+def sim_worker(config, opts, index, stop, recorders):
+    """
+    Simulated worker slot: claims work, renders with `stub_render`, uploads each frame.
+    """
+    rng = random.Random(f"{opts['seed']}:worker{index}")
+    speed = rng.uniform(1 - opts["speed_spread"], 1 + opts["speed_spread"])
+    payload = rng.randbytes(opts["output_size"])
+    recorder = Recorder(config)
+    recorders.append(recorder)
+
+    name = f"bench/{index}"
+    worker_id = recorder.request({"method": "worker_init", "name": name})["worker_id"]
+    while not stop.is_set():
+        work = recorder.request({"method": "get_work", "worker_id": worker_id, "name": name, "wait": 1})
+        if work["status"] != "ok":
+            continue
+
+        job_id = work["job_id"]
+        frames = list(decode(work["frames"]))
+        last_update = time.monotonic()
+        for i, frame in enumerate(frames):
+            seconds = frame_time(opts, job_id, frame) / speed
+            data = stub_render(seconds, payload, frame)
+            recorder.request({"method": "upload_renders", "worker_id": worker_id, "job_id": job_id,
+                "renders": {frame: data}, "times": {frame: seconds}})
+            if time.monotonic() - last_update > STATUS_UPDATE_INTERVAL and i+1 < len(frames):
+                recorder.request({"method": "status_update", "job_id": job_id, "frames": frames[i+1:]})
+                last_update = time.monotonic()
+
+
+def worker_process(config, opts, indices, stop, results):
+    """
+    Run simulated workers as threads until `stop` is set, then put their merged
+    latency samples on the `results` queue.
+    """
+    recorders = []
+    threads = [Thread(target=sim_worker, args=(config, opts, index, stop, recorders)) for index in indices]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    samples = {}
+    for recorder in recorders:
+        for name, values in recorder.samples.items():
+            samples.setdefault(name, []).extend(values)
+    results.put(samples)
+
+
+def usage():
+    """
+    :return: (CPU seconds, peak RSS in MiB) of this process, or (None, None) without `resource`.
+    """
+    if resource is None:
+        return None, None
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss / 1024
+
+
+def run_bench(opts) -> dict:
+    """
+    :param opts: See `DEFAULTS`.
+    :return: Report, see `print_report`.
+    """
+    opts = {**DEFAULTS, **opts}
+    server_cls = AsyncServer if opts["asyncio"] else Server
+
+    # Server logs every request; keep it off the terminal, but still pay for it.
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as root, \
+            open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server = server_cls("127.0.0.1", 0, make_scheduler(opts["scheduler"]), root)
+        config = {"ip": "127.0.0.1", "port": server.sock.getsockname()[1]}
+        # Accept connections before the server thread gets to `start`.
+        server.sock.listen()
+        Thread(target=server.start, daemon=True).start()
+
+        ctx = multiprocessing.get_context("spawn")
+        stop = ctx.Event()
+        results = ctx.Queue()
+        procs = []
+        for i in range(opts["procs"]):
+            indices = list(range(i, opts["workers"], opts["procs"]))
+            procs.append(ctx.Process(target=worker_process, args=(config, opts, indices, stop, results)))
+        for proc in procs:
+            proc.start()
+
+        # Start timing once all workers are waiting for work.
+        deadline = time.monotonic() + opts["timeout"]
+        while time.monotonic() < deadline and \
+                len(make_request(config, {"method": "metrics"})["metrics"]["workers"]) < opts["workers"]:
+            time.sleep(0.1)
+
+        cpu_start, _ = usage()
+        time_start = time.monotonic()
+        job_ids = []
+        for _ in range(opts["jobs"]):
+            response = make_request(config, {"method": "create_job", "blend": b"bench", "is_tar": False,
+                "frames": FrameSet(range(opts["frames"])).encode()})
+            job_ids.append(response["job_id"])
+
+        # Wait for all jobs to finish.
+        deadline = time_start + opts["timeout"]
+        finished = 0
+        for job_id in job_ids:
+            cursor = 0
+            while time.monotonic() < deadline:
+                response = make_request(config, {"method": "job_events", "job_id": job_id,
+                    "cursor": cursor, "wait": 5})
+                cursor = response["cursor"]
+                if response["finished"]:
+                    finished += 1
+                    break
+        elapsed = time.monotonic() - time_start
+        cpu_end, max_rss = usage()
+
+        stop.set()
+        samples = {}
+        for _ in procs:
+            for name, values in results.get().items():
+                samples.setdefault(name, []).extend(values)
+        for proc in procs:
+            proc.join()
+
+        frames = 0
+        for job_id in job_ids:
+            response = make_request(config, {"method": "job_status", "job_id": job_id})
+            frames += sum(1 for _ in decode(response["frames_done"]))
+        metrics = make_request(config, {"method": "metrics"})["metrics"]
+        server.stop()
+
+    return {
+        "options": opts,
+        "completed": finished == len(job_ids),
+        "frames": frames,
+        "seconds": elapsed,
+        "frames_per_second": frames / elapsed,
+        # Time all frames take on workers of speed 1, divided by the worker count.
+        "ideal_seconds": sum(frame_time(opts, job_id, frame)
+            for job_id in job_ids for frame in range(opts["frames"])) / opts["workers"],
+        "latency": {name: {
+            "count": len(values),
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99),
+            "max": max(values),
+        } for name, values in sorted(samples.items())},
+        "server_cpu_seconds": None if cpu_start is None else cpu_end - cpu_start,
+        "server_cpu_percent": None if cpu_start is None else (cpu_end - cpu_start) / elapsed * 100,
+        "server_max_rss_mb": max_rss,
+        "server_locks": metrics["locks"],
+    }
+
+
+def print_report(report):
+    opts = report["options"]
+    print(f"Benchmark: {opts['workers']} workers in {opts['procs']} processes, "
+        f"{opts['jobs']} job(s) of {opts['frames']} frames, {opts['frame_time']} sec/frame, "
+        f"{opts['output_size']} bytes/frame, {'asyncio' if opts['asyncio'] else 'thread'} server")
+    if not report["completed"]:
+        print(f"- Timed out after {opts['timeout']} seconds; numbers cover the frames done so far.")
+    print(f"- Time: {report['seconds']:.2f} sec (ideal {report['ideal_seconds']:.2f})")
+    print(f"- Throughput: {report['frames_per_second']:.1f} frames/sec")
+    print(f"- Latency (ms):")
+    for name, stats in report["latency"].items():
+        print(f"  - {name}: n={stats['count']}, p50={stats['p50']*1000:.2f}, p90={stats['p90']*1000:.2f}, "
+            f"p99={stats['p99']*1000:.2f}, max={stats['max']*1000:.2f}")
+    if report["server_cpu_seconds"] is not None:
+        print(f"- Server CPU: {report['server_cpu_seconds']:.2f} sec ({report['server_cpu_percent']:.0f}%)")
+        print(f"- Server peak memory: {report['server_max_rss_mb']:.0f} MiB")
+    locks = report["server_locks"]["write"]
+    print(f"- Job lock: {locks['contended']} of {locks['acquisitions']} writes contended, "
+        f"{float(locks['wait_time'])*1000:.1f} ms waited")
+
+
+DEFAULTS = {
+    "workers": 100,
+    "procs": min(8, os.cpu_count() or 1),
+    "jobs": 1,
+    "frames": 2000,
+    "frame_time": 0.5,
+    "jitter": 0.2,   # standard deviation of frame time, relative to frame_time
+    "speed_spread": 0.3,   # worker speeds are uniform in 1 +- speed_spread
+    "output_size": 200000,
+    "asyncio": False,
+    "scheduler": "priority",
+    "seed": 0,
+    "timeout": 600,
+}
+
+
+def bench(args):
+    """
+    Entry point of `brn bench`.
+    """
+    opts = {key: getattr(args, key) for key in DEFAULTS if getattr(args, key, None) is not None}
+    report = run_bench(opts)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
@@ -0,0 +1,64 @@
+"""
+Runs inside Blender, started by the worker:
+    blender -b main.blend --python blender_host.py
+
+Keeps the scene loaded and renders frames on request, so Blender startup and
+scene load happen once per job instead of once per batch.
+
+Protocol (one JSON object per line):
+- stdin: {"frame": ..., "path": ..., "format": ..., "border": None}
+    - path: Output path without extension.
+    - format: Blender file format, e.g. "JPEG".
+    - border: Optional [min_x, max_x, min_y, max_y]; render only this region, cropped.
+- stdout: Lines starting with PREFIX, followed by JSON:
+    - {"ready": true} once the scene is loaded.
+    - {"frame": ..., "file": ...} after each frame is written.
+    - {"frame": ..., "error": ...} if rendering failed.
+All other stdout lines are Blender's own output.
+EOF on stdin exits Blender.
+"""
+
+import json
+import sys
+
+import bpy
+
+PREFIX = "BRN_HOST "
+
+
+def reply(data):
+    sys.stdout.write(PREFIX + json.dumps(data) + "\n")
+    sys.stdout.flush()
+
+
+def render(request):
+    scene = bpy.context.scene
+    scene.frame_set(request["frame"])
+    scene.render.image_settings.file_format = request["format"]
+    scene.render.use_file_extension = True
+    scene.render.filepath = request["path"]
+    border = request.get("border")
+    scene.render.use_border = border is not None
+    scene.render.use_crop_to_border = border is not None
+    if border is not None:
+        (scene.render.border_min_x, scene.render.border_max_x,
+            scene.render.border_min_y, scene.render.border_max_y) = border
+    bpy.ops.render.render(write_still=True)
+    return bpy.path.abspath(scene.render.frame_path(frame=request["frame"]))
+
+
+def main():
+    reply({"ready": True})
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            file = render(request)
+        except Exception as e:
+            reply({"frame": request["frame"], "error": str(e)})
+        else:
+            reply({"frame": request["frame"], "file": file})
+
+
+main()
@@ -0,0 +1,167 @@
+"""
+Worker-side blend cache, keyed by content hash of blend.tar.gz.
+"""
+
+import hashlib
+import os
+import shutil
+import tarfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from .conn import CHUNK_SIZE, download_file
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path, exclusive=True, blocking=True):
+    """
+    flock on `path`. Yields False if not blocking and the lock is taken.
+    Without fcntl (Windows), always succeeds without locking.
+    """
+    if fcntl is None:
+        yield True
+        return
+
+    with open(path, "a") as f:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class BlendCache:
+    """
+    Persistent, size-bounded cache of extracted blends.
+    Shared by all worker processes on the host.
+
+    File structure:
+    - root
+        - {hash}/       # extracted blend.tar.gz; mtime is last use time.
+            - main.blend
+            ...
+        - {hash}.size   # total size of extracted files (bytes).
+        - {hash}.lock   # flock: shared while in use, exclusive while extracting or evicting.
+
+    Config keys:
+    - "cache_dir": Cache root. Default `~/.cache/brn/blends`.
+    - "cache_size": Max total size in bytes. Default 20 GiB.
+    """
+
+    default_dir = Path.home() / ".cache" / "brn" / "blends"
+    default_size = 20 * 2**30
+
+    def __init__(self, config):
+        self.config = config
+        self.root = Path(config.get("cache_dir", self.default_dir))
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = config.get("cache_size", self.default_size)
+
+    @contextmanager
+    def use(self, job_id, blend_hash):
+        """
+        Ensure blend is extracted, and hold it while the context is active
+        so other processes don't evict it.
+        :return: Path to main.blend.
+        """
+        if not blend_hash.isalnum():
+            raise ValueError(f"Invalid blend hash {blend_hash}")
+        path = self.root / blend_hash
+        lock_path = self.root / f"{blend_hash}.lock"
+
+        while True:
+            if not path.exists():
+                with file_lock(lock_path):
+                    if not path.exists():
+                        self.fetch(job_id, blend_hash)
+                self.evict(keep=blend_hash)
+
+            with file_lock(lock_path, exclusive=False):
+                # May have been evicted between fetch and shared lock.
+                if path.exists():
+                    os.utime(path)
+                    yield path / "main.blend"
+                    return
+
+    def hashes(self):
+        """
+        Hashes of all cached blends.
+        """
+        return [path.name for path in self.root.iterdir() if path.is_dir() and not path.name.startswith(".")]
+
+    def prefetch(self, job_id, blend_hash):
+        """
+        Download and extract now, without holding the entry.
+        """
+        with self.use(job_id, blend_hash):
+            pass
+
+    def fetch(self, job_id, blend_hash):
+        """
+        Download and extract. Caller holds the exclusive lock.
+        """
+        print(f"  Downloading blend.tar.gz of job {job_id}...")
+        tar_path = self.root / f"{blend_hash}.tar.gz"
+        resp = download_file(self.config, {"method": "download_blend", "job_id": job_id, "stream": True}, tar_path)
+        if resp["status"] != "ok":
+            raise Exception("Failed to download blend file.")
+
+        h = hashlib.sha256()
+        with tar_path.open("rb") as f:
+            while data := f.read(CHUNK_SIZE):
+                h.update(data)
+        if h.hexdigest() != blend_hash:
+            tar_path.unlink()
+            raise Exception("Downloaded blend file does not match hash.")
+
+        # Extract next to the final path, then rename, so a crash never leaves
+        # a partial directory that looks complete.
+        tmp_path = self.root / f".{blend_hash}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        with tarfile.open(tar_path) as tar:
+            tar.extractall(tmp_path)
+        tar_path.unlink()
+
+        size = sum(f.stat().st_size for f in tmp_path.rglob("*") if f.is_file())
+        (self.root / f"{blend_hash}.size").write_text(str(size))
+        tmp_path.rename(self.root / blend_hash)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until under `max_size`.
+        Entries in use by any process are skipped.
+        """
+        entries = []
+        for path in self.root.iterdir():
+            if path.is_dir() and not path.name.startswith(".") and path.name != keep:
+                size_path = self.root / f"{path.name}.size"
+                size = int(size_path.read_text()) if size_path.exists() else 0
+                entries.append((path.stat().st_mtime, path, size))
+
+        total = sum(size for _, _, size in entries)
+        if keep is not None and (self.root / f"{keep}.size").exists():
+            total += int((self.root / f"{keep}.size").read_text())
+
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.max_size:
+                break
+            with file_lock(self.root / f"{path.name}.lock", blocking=False) as locked:
+                if not locked:
+                    continue
+                print(f"  Evicting cached blend {path.name}")
+                shutil.rmtree(path, ignore_errors=True)
+                (self.root / f"{path.name}.size").unlink(missing_ok=True)
+                total -= size
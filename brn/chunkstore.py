@@ -0,0 +1,148 @@
+"""
+Content-addressed chunk store shared by all jobs on the server.
+"""
+
+import gzip
+import hashlib
+import os
+import re
+import tarfile
+import threading
+from pathlib import Path, PurePosixPath
+
+from .conn import CHUNK_SIZE
+
+# Chunk names: lowercase hex SHA-256.
+HASH_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def chunk_hashes(path) -> list[str]:
+    """
+    SHA-256 of each CHUNK_SIZE chunk of a file.
+    """
+    hashes = []
+    with open(path, "rb") as f:
+        while data := f.read(CHUNK_SIZE):
+            hashes.append(hashlib.sha256(data).hexdigest())
+    return hashes
+
+
+def make_manifest(path) -> list:
+    """
+    Manifest of a blend file or directory: [[relpath, [chunk_hash, ...]], ...], sorted by path.
+    A single blend file is stored as "main.blend".
+    Paths are UTF-8 bytes, since bcon miscounts the length of non-ASCII strings.
+    """
+    path = Path(path)
+    if path.is_file():
+        return [[b"main.blend", chunk_hashes(path)]]
+
+    manifest = []
+    for f in sorted(path.rglob("*")):
+        if f.is_file():
+            manifest.append([f.relative_to(path).as_posix().encode(), chunk_hashes(f)])
+    return manifest
+
+
+def valid_hash(chunk_hash):
+    """
+    False for anything but a SHA-256 hex digest, so hashes can't name other files.
+    """
+    return isinstance(chunk_hash, str) and HASH_RE.fullmatch(chunk_hash) is not None
+
+
+def valid_relpath(relpath: str):
+    """
+    False for paths that would escape the extraction directory.
+    """
+    path = PurePosixPath(relpath)
+    return relpath != "" and not path.is_absolute() and ".." not in path.parts
+
+
+class ChunkReader:
+    """
+    File-like object reading a sequence of chunks as one stream.
+    """
+
+    def __init__(self, store, hashes):
+        self.paths = [store.path(h) for h in hashes]
+        self.file = None
+
+    def read(self, size=-1):
+        out = bytearray()
+        while size < 0 or len(out) < size:
+            if self.file is None:
+                if not self.paths:
+                    break
+                self.file = open(self.paths.pop(0), "rb")
+            data = self.file.read(-1 if size < 0 else size - len(out))
+            if not data:
+                self.file.close()
+                self.file = None
+                continue
+            out += data
+        return bytes(out)
+
+
+class ChunkStore:
+    """
+    Chunks named by their SHA-256, deduplicated across all uploads.
+
+    File structure:
+    - root
+        - ab/
+            - abcdef...  # chunk whose hash starts with "ab"
+        ...
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True)
+
+    def path(self, chunk_hash):
+        if not valid_hash(chunk_hash):
+            raise ValueError(f"Invalid chunk hash {chunk_hash!r}")
+        return self.root / chunk_hash[:2] / chunk_hash
+
+    def has(self, chunk_hash):
+        return self.path(chunk_hash).exists()
+
+    def missing(self, hashes):
+        """
+        :return: Hashes not in the store, without duplicates.
+            Check them with `valid_hash` first.
+        """
+        return [h for h in dict.fromkeys(hashes) if not self.has(h)]
+
+    def put(self, chunk_hash, data):
+        """
+        Store chunk if its data matches the hash.
+        :return: True if stored (or already present).
+        """
+        if not valid_hash(chunk_hash) or len(data) > CHUNK_SIZE or hashlib.sha256(data).hexdigest() != chunk_hash:
+            return False
+
+        path = self.path(chunk_hash)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(f"{chunk_hash}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+        return True
+
+    def file_size(self, hashes):
+        return sum(self.path(h).stat().st_size for h in hashes)
+
+    def build_archive(self, manifest, path):
+        """
+        Write tar.gz of all files in manifest.
+        Output only depends on the manifest, so equal contents give equal blend hashes.
+        """
+        # No file name or timestamp in the gzip header.
+        with open(path, "wb") as out, gzip.GzipFile("", "wb", fileobj=out, mtime=0) as gz, \
+                tarfile.open(fileobj=gz, mode="w") as tar:
+            for relpath, hashes in manifest:
+                info = tarfile.TarInfo(relpath)
+                info.size = self.file_size(hashes)
+                info.mode = 0o644
+                tar.addfile(info, ChunkReader(self, hashes))
@@ -1,56 +1,93 @@
+import json
 import sys
 import tarfile
-import tempfile
 import time
 from pathlib import Path
 from tqdm import tqdm
 
-from .conn import make_request
+from .chunkstore import make_manifest
+from .conn import CHUNK_SIZE, download_file, make_request
+from .frameset import FrameSet
 from .interrupt import interrupted
+from .storage import FORMATS
 
 
-def parse_frames(frames: str):
+def parse_frames(frames: str) -> FrameSet:
+    result = FrameSet()
     for section in frames.split(","):
         parts = list(map(int, section.split(":")))
         if len(parts) == 1:
             print(f"  - Frame {parts[0]}")
-            yield parts[0]
+            result.add(parts[0])
         elif len(parts) == 2:
             print(f"  - Frames {parts[0]} to {parts[1]}")
-            yield from range(parts[0], parts[1])
+            result.add_range(parts[0], parts[1])
         elif len(parts) == 3:
             print(f"  - Frames {parts[0]} to {parts[1]} by {parts[2]}")
-            yield from range(parts[0], parts[1], parts[2])
+            result.add_range(parts[0], parts[1], parts[2])
+    return result
+
+
+def upload_chunks(config, blend_path, manifest):
+    """
+    Upload the chunks in manifest that the server doesn't have.
+    """
+    response = make_request(config, {"method": "missing_chunks",
+        "hashes": [h for _, hashes in manifest for h in hashes]})
+    missing = set(response["missing"])
+    total = sum(len(hashes) for _, hashes in manifest)
+    print(f"Uploading {len(missing)} of {total} chunks.")
+
+    for relpath, hashes in manifest:
+        if not missing.intersection(hashes):
+            continue
+        path = blend_path if blend_path.is_file() else blend_path / relpath.decode()
+        with path.open("rb") as f:
+            for i, h in enumerate(hashes):
+                if h in missing:
+                    f.seek(i * CHUNK_SIZE)
+                    response = make_request(config, {"method": "put_chunk", "hash": h, "data": f.read(CHUNK_SIZE)})
+                    assert response["status"] == "ok", f"Failed to upload {relpath.decode()}"
+                    missing.discard(h)
 
 
 def create_job(config, args):
     blend_path = Path(args.blend)
     is_blend = blend_path.is_file() and blend_path.suffix == ".blend"
     if not is_blend:
-        # Create tar archive.
-        print("Directory given; creating tar archive.")
+        print("Directory given; uploading all files.")
 
         # Ensure `main.blend` exists.
         if not (blend_path / "main.blend").exists():
             print("main.blend not found in directory.")
             sys.exit(1)
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmpfile = Path(tmpdir) / "blend.tar.gz"
-            with tarfile.open(tmpfile, "w:gz") as tar:
-                for f in blend_path.iterdir():
-                    tar.add(f, arcname=f.name)
-            blend_data = tmpfile.read_bytes()
-    else:
-        blend_data = blend_path.read_bytes()
-
     print(f"Creating job:")
-    print(f"- Blend: {blend_path}, " + ("single file" if is_blend else "tar archive"))
+    print(f"- Blend: {blend_path}, " + ("single file" if is_blend else "directory"))
+    print(f"- Priority: {args.priority}, user: {args.user}, format: {args.format}")
+    if args.tiles > 1:
+        print(f"- Tiles per frame: {args.tiles}")
     print(f"- Frames: ")
-    frames = list(parse_frames(args.frames))
+    frames = parse_frames(args.frames)
+    print(f"  ({len(frames)} frames)")
 
     print("Sending job to server.")
-    response = make_request(config, {"method": "create_job", "blend": blend_data, "frames": frames, "is_tar": not is_blend})
+    manifest = make_manifest(blend_path)
+    upload_chunks(config, blend_path, manifest)
+    request = {"method": "create_job", "manifest": manifest, "frames": frames.encode(),
+        "priority": args.priority, "user": args.user}
+    if args.deadline is not None:
+        request["deadline"] = int(time.time() + args.deadline * 60)
+    if args.tiles > 1:
+        request["tiles"] = args.tiles
+    if args.format != "JPEG":
+        request["format"] = args.format
+    if args.packed:
+        request["packed"] = True
+    response = make_request(config, request)
+    if response["status"] == "tiles_unsupported":
+        print("Server can't split frames into tiles; install Pillow on the server, and don't use EXR.")
+        sys.exit(1)
     assert response["status"] == "ok"
 
     job_id = response["job_id"]
@@ -68,48 +105,54 @@ def download_results(config, args):
     print(f"- Output directory: {outdir}")
 
     response = make_request(config, {"method": "job_status", "job_id": job_id})
-    all_frames = response["frames_requested"]
+    all_frames = FrameSet.decode(response["frames_requested"])
 
     # Check which frames we already have
     frames_done = set()
     for file in outdir.iterdir():
-        if file.suffix == ".jpg":
+        if file.suffix[1:] in FORMATS.values() and file.stem.isdigit():
             frames_done.add(int(file.stem))
     print(f"Already downloaded {len(frames_done)} frames.")
 
+    # Position in the server's list of completed frames, saved to resume without re-downloading.
+    cursor_path = outdir / ".brn_cursor"
+    cursor = int(cursor_path.read_text()) if cursor_path.exists() else 0
+
+    # Frames come as a streamed tar archive, which is much cheaper for the server than a bcon dict.
+    tar_path = outdir / ".brn_download.tar"
     pbar = tqdm(total=len(all_frames) - len(frames_done), desc="Waiting...")
-    delay = 0
-    while not interrupted():
-        time.sleep(delay)
-        response = make_request(config, {"method": "job_status", "job_id": job_id})
+    while not interrupted() and len(frames_done) < len(all_frames):
+        # Server holds the request until frames complete, so there's no need to poll.
+        response = download_file(config, {"method": "download_renders", "job_id": job_id,
+            "cursor": cursor, "wait": 10, "tar": True}, tar_path)
         if response["status"] != "ok":
+            time.sleep(1)
             continue
 
-        # Check if we got any new frames
-        did_something = False
-        for frame in response["frames_done"]:
-            if frame not in frames_done:
-                did_something = True
-
-                # Download the frame
-                response = make_request(config, {"method": "download_render", "job_id": job_id, "frame": frame})
-                if response["status"] == "ok":
-                    (outdir / f"{frame}.jpg").write_bytes(response["data"])
-                else:
-                    print(f"Failed to download frame {frame}")
-                    continue
-
-                frames_done.add(frame)
-                pbar.set_description(f"Got frame {frame}")
-                pbar.update(1)
-
-        if len(frames_done) == len(all_frames):
+        with tarfile.open(tar_path) as tar:
+            for member in tar:
+                frame = int(member.name.split(".")[0])
+                if frame not in frames_done:
+                    # Named by us, not by the archive.
+                    (outdir / f"{frame}.{response['ext']}").write_bytes(tar.extractfile(member).read())
+                    frames_done.add(frame)
+                    pbar.set_description(f"Got frame {frame}")
+                    pbar.update(1)
+        tar_path.unlink()
+
+        cursor = response["cursor"]
+        cursor_path.write_text(str(cursor))
+        if response["finished"]:
             break
 
-        if did_something:
-            delay = 0
-        else:
-            delay = min(delay + 1, 10)
-
     pbar.close()
     print("Done.")
+
+
+def show_metrics(config, args):
+    response = make_request(config, {"method": "metrics", "prometheus": not args.json})
+    assert response["status"] == "ok"
+    if args.json:
+        print(json.dumps(response["metrics"], indent=4))
+    else:
+        print(response["text"], end="")
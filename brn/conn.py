@@ -1,41 +1,372 @@
+import os
 import struct
-import time
-from socket import socket, AF_INET, SOCK_STREAM
+import zlib
+from pathlib import Path
+from socket import socket, AF_INET, MSG_PEEK, SOCK_STREAM
+from threading import Lock, Thread, get_ident
 from typing import Any
 
 import bcon
 
+try:
+    from socket import AF_UNIX
+except ImportError:
+    AF_UNIX = None
 
-def recv_len(conn, length):
-    data = b""
-    tries = 0
-    while len(data) < length:
-        data += conn.recv(length - len(data))
-        tries += 1
-        if tries > 10000:
-            raise Exception("recv() failed")
-        time.sleep(0.001)
+# Frame header: protocol version, flags, payload length.
+HEADER = struct.Struct("<BBQ")
+VERSION = 1
+# Flag: payload is a raw file chunk instead of a bcon message.
+FLAG_RAW = 1
+
+# Unit of streamed transfers. Offsets and checksums are per chunk.
+CHUNK_SIZE = 4 * 2**20
+
+# Requests that must not be sent twice, as the server creates something new for each.
+# Only retried if they didn't reach the server, see `ConnectionPool.run`.
+NOT_IDEMPOTENT = frozenset({"create_job", "worker_init", "get_work"})
+
+
+class ChecksumError(ConnectionError):
+    pass
 
+
+def recv_into(conn, buf):
+    """
+    Fill `buf` (bytearray or memoryview) completely from the socket.
+    """
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(view):
+        n = conn.recv_into(view[pos:])
+        if n == 0:
+            raise ConnectionError("Connection closed.")
+        pos += n
+
+def recv_len(conn, length):
+    data = bytearray(length)
+    recv_into(conn, data)
     return data
 
+def send_buffers(conn, buffers):
+    """
+    Send all buffers with as few syscalls as possible (scatter-gather).
+    """
+    if not hasattr(conn, "sendmsg"):
+        for buf in buffers:
+            conn.sendall(buf)
+        return
+
+    views = [memoryview(buf).cast("B") for buf in buffers if len(buf) > 0]
+    while views:
+        sent = conn.sendmsg(views)
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+def recv_header(conn, expect_flags):
+    version, flags, length = HEADER.unpack(recv_len(conn, HEADER.size))
+    if version != VERSION:
+        raise ConnectionError(f"Unsupported protocol version {version}.")
+    if flags != expect_flags:
+        raise ConnectionError(f"Unexpected frame flags {flags}.")
+    return length
+
 def send(conn, obj):
+    """
+    :return: Bytes sent.
+    """
     data = bcon.dumps(obj)
-    conn.send(struct.pack("<I", len(data)))
-    conn.send(data)
+    send_buffers(conn, (HEADER.pack(VERSION, 0, len(data)), data))
+    return HEADER.size + len(data)
 
-def recv(conn):
-    length = struct.unpack("<I", recv_len(conn, 4))[0]
+def recv_message(conn):
+    """
+    :return: (obj, bytes received)
+    """
+    length = recv_header(conn, 0)
     data = recv_len(conn, length)
-    return bcon.loads(data)
+    return bcon.loads(data), HEADER.size + length
+
+def recv(conn):
+    return recv_message(conn)[0]
+
+
+def file_checksums(path) -> list[int]:
+    """
+    CRC32 of each CHUNK_SIZE chunk of the file.
+    Cached in a `.crc` file next to it, so large files are only hashed once.
+    The cache is replaced atomically, so concurrent requests never read a partial one.
+    """
+    path = Path(path)
+    cache = path.with_name(path.name + ".crc")
+    if cache.exists() and cache.stat().st_mtime_ns >= path.stat().st_mtime_ns:
+        data = cache.read_bytes()
+        return list(struct.unpack(f"<{len(data)//4}I", data))
+
+    checksums = []
+    buf = bytearray(CHUNK_SIZE)
+    with path.open("rb") as f:
+        while (n := f.readinto(buf)) > 0:
+            checksums.append(zlib.crc32(memoryview(buf)[:n]))
+    # Unique per thread, as several requests may compute the checksums at once.
+    tmp_path = cache.with_name(f"{cache.name}.{os.getpid()}.{get_ident()}.tmp")
+    tmp_path.write_bytes(struct.pack(f"<{len(checksums)}I", *checksums))
+    tmp_path.replace(cache)
+    return checksums
+
+def send_file(conn, path, start=0):
+    """
+    Send file from chunk index `start` as raw frames, one per chunk.
+    Data goes from disk to socket with sendfile().
+    :return: Bytes sent.
+    """
+    sent = 0
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = start * CHUNK_SIZE
+        while offset < size:
+            length = min(CHUNK_SIZE, size - offset)
+            conn.sendall(HEADER.pack(VERSION, FLAG_RAW, length))
+            conn.sendfile(f, offset, length)
+            offset += length
+            sent += HEADER.size + length
+    return sent
+
+def recv_file(conn, f, checksums):
+    """
+    Receive one raw frame per checksum and write it to file object `f`.
+    Each chunk is verified before it is written, so on error `f` only
+    contains good chunks and the transfer can resume from there.
+    """
+    buf = bytearray(CHUNK_SIZE)
+    for checksum in checksums:
+        length = recv_header(conn, FLAG_RAW)
+        if length > CHUNK_SIZE:
+            raise ConnectionError(f"Chunk too large: {length}")
+        view = memoryview(buf)[:length]
+        recv_into(conn, view)
+        if zlib.crc32(view) != checksum:
+            raise ChecksumError("Chunk checksum mismatch.")
+        f.write(view)
+
+
+class Connection:
+    """
+    Long-lived connection to the server that carries many requests.
+    Each request is tagged with an "id", which the server echoes in the response.
+    Not thread safe; use one per thread (see `make_request`).
+    """
+
+    def __init__(self, addr, timeout=None):
+        """
+        :param addr: (ip, port), or path of a Unix socket.
+        :param timeout: Seconds a send or receive may block before raising TimeoutError; None for no limit.
+        """
+        self.addr = addr
+        self.sock = socket(AF_UNIX if isinstance(addr, str) else AF_INET, SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(addr)
+        self.next_id = 0
+        self.sent = 0   # Requests sent completely.
+
+    def close(self):
+        self.sock.close()
+
+    def is_open(self) -> bool:
+        """
+        Check without blocking that the server hasn't closed the connection (e.g. idle timeout).
+        """
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            # Any data before a request means the connection is closed or out of sync.
+            self.sock.recv(1, MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.sock.settimeout(timeout)
+
+    def _tag(self, data):
+        data = dict(data)
+        data["id"] = self.next_id
+        self.next_id = (self.next_id + 1) % 2**31
+        return data
+
+    def _check(self, request, response):
+        if response.get("id") != request["id"]:
+            raise ConnectionError(f"Response ID mismatch: expected {request['id']}, got {response.get('id')}")
+        response.pop("id")
+        return response
+
+    def request(self, data) -> dict[str, Any]:
+        request = self._tag(data)
+        send(self.sock, request)
+        self.sent += 1
+        return self._check(request, recv(self.sock))
+
+    def download(self, data, f) -> dict[str, Any]:
+        """
+        Streamed request: response is followed by raw chunks, which are written to `f`.
+        Can't be pipelined with other requests.
+        """
+        response = self.request(data)
+        if response["status"] == "ok":
+            recv_file(self.sock, f, response["checksums"])
+        return response
+
+    def request_many(self, requests) -> list[dict[str, Any]]:
+        """
+        Pipeline requests: send all of them without waiting, then read responses in order.
+        Sending happens on a separate thread so large requests and responses can't
+        deadlock on full socket buffers.
+        """
+        requests = [self._tag(data) for data in requests]
+
+        errors = []
+        def sender():
+            try:
+                for request in requests:
+                    send(self.sock, request)
+                    self.sent += 1
+            except OSError as e:
+                errors.append(e)
+        thread = Thread(target=sender)
+        thread.start()
+
+        try:
+            responses = [self._check(request, recv(self.sock)) for request in requests]
+        finally:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return responses
+
+
+class ConnectionPool:
+    """
+    Idle connections per server address.
+    """
+
+    def __init__(self):
+        self.idle: dict[tuple, list[Connection]] = {}
+        self.lock = Lock()
+
+    def get(self, addr, timeout=None) -> tuple[Connection, bool]:
+        """
+        :return: (connection, reused)
+        """
+        while True:
+            with self.lock:
+                conns = self.idle.get(addr)
+                conn = conns.pop() if conns else None
+            if conn is None:
+                return Connection(addr, timeout), False
+            if conn.is_open():
+                return conn, True
+            conn.close()
+
+    def put(self, conn: Connection):
+        with self.lock:
+            self.idle.setdefault(conn.addr, []).append(conn)
+
+    def run(self, config, func, idempotent=True):
+        """
+        Call `func(conn)` on a pooled connection.
+        If a reused connection turns out to be closed (e.g. idle timeout on the
+        server), retry once on a new one.
+        :param config: {"ip": ..., "port": ...}, or {"unix": path}; optionally "timeout" for new
+            connections, see `Connection`.
+        :param idempotent: If False, only retry if no request was sent completely,
+            since the server may have handled it before the connection broke.
+        """
+        addr = config["unix"] if "unix" in config else (config["ip"], config["port"])
+        conn, reused = self.get(addr, config.get("timeout"))
+        sent = conn.sent
+        try:
+            result = func(conn)
+        except (ConnectionError, OSError):
+            conn.close()
+            if not reused or (not idempotent and conn.sent > sent):
+                raise
+            conn = Connection(addr, config.get("timeout"))
+            try:
+                result = func(conn)
+            except BaseException:
+                conn.close()
+                raise
+        except BaseException:
+            conn.close()
+            raise
+
+        self.put(conn)
+        return result
+
+
+_pool = ConnectionPool()
+
+
+def idempotent(data) -> bool:
+    """
+    Whether request `data` may safely be sent again, see `NOT_IDEMPOTENT`.
+    """
+    return data.get("method") not in NOT_IDEMPOTENT
 
 
 def make_request(config, data) -> dict[str, Any]:
     """
-    Create connection, request, response.
+    Send request and return response, over a pooled persistent connection.
+    """
+    return _pool.run(config, lambda conn: conn.request(data), idempotent(data))
+
+
+def make_requests(config, requests) -> list[dict[str, Any]]:
+    """
+    Send several pipelined requests over one pooled connection.
+    """
+    return _pool.run(config, lambda conn: conn.request_many(requests),
+        all(idempotent(data) for data in requests))
+
+
+def download_file(config, data, path, retries=3) -> dict[str, Any]:
     """
-    conn = socket(AF_INET, SOCK_STREAM)
-    conn.connect((config["ip"], config["port"]))
-    send(conn, data)
-    response = recv(conn)
-    conn.close()
+    Streamed download of a file to `path`.
+    Partial data is kept in `path.part`; the request is sent with "offset"
+    set to the number of chunks already there, so interrupted downloads resume.
+    :param data: Request; server must support "offset" and respond with "checksums" and "size".
+    :return: Response (without data).
+    """
+    path = Path(path)
+    part = path.with_name(path.name + ".part")
+    part.touch()
+
+    with part.open("r+b") as f:
+        def attempt(conn):
+            start = f.seek(0, os.SEEK_END) // CHUNK_SIZE
+            f.seek(start * CHUNK_SIZE)
+            f.truncate()
+            response = conn.download({**data, "offset": start}, f)
+            if response["status"] == "ok" and "size" in response and f.tell() != int(response["size"]):
+                raise ChecksumError(f"Downloaded {f.tell()} bytes, expected {response['size']}.")
+            return response
+
+        for i in range(retries):
+            try:
+                response = _pool.run(config, attempt)
+                break
+            except ConnectionError:
+                if i == retries - 1:
+                    raise
+
+    if response["status"] == "ok":
+        part.replace(path)
+    else:
+        part.unlink()
     return response
@@ -1,34 +1,63 @@
+import gzip
+import hashlib
+import io
+import math
 import pickle
-import random
+import secrets
 import tarfile
-import tempfile
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
 
-
-class FileLock:
+from . import tiles
+from .chunkstore import ChunkStore, valid_hash, valid_relpath
+from .conn import CHUNK_SIZE
+from .frameset import FrameLog, FrameSet
+from .jobindex import JobIndex
+from .jobstate import JobState, write_atomic
+from .lock import LockRegistry, Notifier
+from .metrics import Metrics
+from .scheduler import Scheduler, make_scheduler
+from .shard import owner
+from .storage import RenderStore, make_store
+from .timing import TimingModel
+
+
+def file_hash(path):
     """
-    If file is present, means something is locked.
-    Wait until file is deleted, then re-create it and continue.
+    SHA-256 hex digest of file contents.
     """
+    h = hashlib.sha256()
+    buf = bytearray(CHUNK_SIZE)
+    with open(path, "rb") as f:
+        while (n := f.readinto(buf)) > 0:
+            h.update(memoryview(buf)[:n])
+    return h.hexdigest()
 
-    def __init__(self, path):
-        self.path = Path(path)
-
-    def __enter__(self):
-        while self.path.exists():
-            time.sleep(0.01)
-        self.path.touch()
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.path.unlink()
+def wrap_blend(f, size, path):
+    """
+    Write a blend file as `main.blend` in a tar.gz archive.
+    Output only depends on the file's contents, so identical blends get identical blend hashes.
+    :param f: File object of blend.
+    """
+    # No file name or timestamp in the gzip header.
+    with open(path, "wb") as out, gzip.GzipFile("", "wb", fileobj=out, mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode="w") as tar:
+        info = tarfile.TarInfo("main.blend")
+        info.size = size
+        tar.addfile(info, f)
 
 
 class DataManager:
     """
-    Manages current jobs in temporary directory.
+    Manages jobs in the server's data directory.
     Used by server.
 
+    Job state is held in memory (see JobState) and is the source of truth;
+    the files below are only written, except when loading at startup.
+
     File structure:
     - DataManager root
         - 0   # job 0
@@ -37,22 +66,31 @@ class DataManager:
             - blend.tar.gz    # contains user's blend, textures, etc.
                 - main.blend  # blend file to render.
                 ...
-            - status.pkl  # dictionary containing:
-                - "done": List of frames done.
+            - status.pkl  # snapshot of JobState, frame lists as runs (see `frameset.py`):
+                - "info": Job metadata; "blend_hash" is SHA-256 of blend.tar.gz.
+                - "frames": Frames requested.
+                - "done": Frames done, in completion order.
                 - "pending": Map of frames being processed to time started.
-                - "todo": List of frames not started.
-                - "batch_size": Map of worker ID to batch_size. With each batch, this is changed
-                    to make work time closer to `tgt_batch_time`.
-                - "last_batch_update": Map of ID to last time batch_size was updated. Prevent
-                    changing batch_size too often.
+                - "todo": Frames not started.
+                - "timing": Map of worker ID to seconds per frame estimate; batches are sized
+                    so work time is close to `tgt_batch_time`.
+                - "frame_time": Seconds per frame estimate over all workers.
                 - "last_status_update": Map of frame to when worker pinged server. If worker
                     doesn't ping for too long, remove frame from "pending" and add to "todo".
-            - done.txt   # if present, means no more "todo" frames.
-            - lock.txt   # if present, some thread is processing.
-            - renders/   # rendered images
-                - 0.jpg
+            - manifest.pkl  # if created from chunks; blend.tar.gz is rebuilt from it.
+            - journal.pkl  # changes since status.pkl was written.
+            - lock.txt   # flock target, only used with `process_lock`.
+            - renders/   # rendered images, see `storage.py`
+                - 0.jpg   # or 0.pack, ... and index.bin if packed.
                 ...
+                - tiles/   # if split into tiles: tiles of frames not assembled yet.
+                    - {unit}.png
         ...
+        - index.db  # JobIndex of all jobs.
+        - timing.pkl  # per-worker estimates by worker name, see TimingModel. timing.{shard}.pkl if sharded.
+        - alive  # touched while the server runs, to measure outages. alive.{shard} if sharded.
+        - uploads/  # temporary files, e.g. archives built for create_job.
+        - objects/  # ChunkStore shared by all jobs.
     """
 
     # Ideal max time a worker works for per batch (sec).
@@ -61,153 +99,629 @@ class DataManager:
     tgt_batch_time = 40
     max_batch_size = 100
     status_update_timeout = 20
-
-    def __init__(self, root):
+    # Finished jobs kept in memory.
+    finished_cache_size = 100
+    # A pending frame is a straggler once it takes this many times the worker's
+    # mean frame time (and 3 standard deviations) longer than expected.
+    speculate_factor = 2
+    # Touch the alive file this often (sec).
+    alive_interval = 5
+
+    def __init__(self, root, process_lock=False, scheduler: Scheduler = None, shard=None):
+        """
+        :param process_lock: Also take an fcntl lock for each job write, for
+            multiple server processes sharing one root.
+        :param scheduler: Decides which job a worker gets. Default: priority with cache affinity.
+        :param shard: (index, count) if the server runs as several processes; this one
+            then only creates and loads its own jobs, see `shard.py`.
+        """
         self.root = root
         self.root.mkdir(exist_ok=True)
+        self.shard = shard
+
+        self.locks = LockRegistry(root if process_lock else None)
+        self.metrics = Metrics()
+        # Notified when frames of the job complete.
+        self.job_notifiers: dict[str, Notifier] = {}
+        # Notified when frames become available to workers.
+        self.work_notifier = Notifier()
+
+        self.timing = TimingModel(self.root / ("timing.pkl" if shard is None else f"timing.{shard[0]}.pkl"))
+        # {worker_id: name} of this session's workers, see `name_worker`.
+        self.worker_names: dict[int, str] = {}
+        # {(job_id, worker_id): time}, to time frames of workers that don't report render times.
+        self.last_complete = {}
+
+        self.upload_dir = self.root / "uploads"
+        self.upload_dir.mkdir(exist_ok=True)
+        self.chunks = ChunkStore(self.root / "objects")
+
+        # Holds only jobs with frames in "todo". Taken inside job locks, never around them.
+        self.scheduler = scheduler if scheduler is not None else make_scheduler()
+        self.scheduler_lock = threading.Lock()
+
+        # Touched by `keep_alive`; its age is how long the server was down, up to `alive_interval`.
+        self.alive_path = self.root / ("alive" if shard is None else f"alive.{shard[0]}")
+        outage = time.time() - self.alive_path.stat().st_mtime if self.alive_path.exists() else 0
+
+        # Unfinished jobs are always in memory; finished ones are loaded on
+        # demand and kept in a small LRU cache.
+        self.index = JobIndex(self.root)
+        self.jobs: dict[str, JobState] = {}
+        self.finished: OrderedDict[str, JobState] = OrderedDict()
+        self.finished_lock = threading.Lock()
+        # Render stores of jobs in `jobs` or `finished`.
+        self.stores: dict[str, RenderStore] = {}
+        self.stores_lock = threading.Lock()
+        for job_id in self.index.active():
+            if shard is not None and owner(job_id, shard[1]) != shard[0]:
+                continue
+            if not (self.root / job_id / "status.pkl").exists():
+                # Creation never finished.
+                self.index.finish(job_id)
+                continue
+            job = JobState.load(self.root / job_id, self.metrics)
+            if not job.todo and not job.pending:
+                self.index.finish(job_id)
+                job.close()
+                continue
+            if job.pending and outage > self.status_update_timeout:
+                # No worker could send status updates for longer than the timeout.
+                print(f"Requeuing frames pending during outage: JobID={job_id}, Frames={len(job.pending)}")
+                job.record("requeue", list(job.pending))
+            self.jobs[job_id] = job
+            self.schedule(job_id)
+        self.alive_path.touch()
+        threading.Thread(target=self.keep_alive, daemon=True).start()
+
+    def name_worker(self, worker_id, name):
+        """
+        Remember the stable name of a worker (random) ID, for `timing`.
+        Workers send it with "worker_init" and "get_work", so it is also learned
+        after a server restart and by shards the worker didn't init with.
+        """
+        if isinstance(name, str):
+            self.worker_names[worker_id] = name
+
+    def keep_alive(self):
+        """
+        Touch the alive file every `alive_interval`, whether or not requests come in.
+        Runs in a background thread until the data directory is gone.
+        """
+        while True:
+            time.sleep(self.alive_interval)
+            try:
+                self.alive_path.touch()
+            except OSError:
+                break
 
     def lock(self, job_id):
         """
-        Return FileLock object for job_id.
+        Return exclusive (writer) lock context for job_id.
+        """
+        return self.locks.write(job_id)
+
+    def read_lock(self, job_id):
+        """
+        Return shared (reader) lock context for job_id.
+        """
+        return self.locks.read(job_id)
+
+    def job_notifier(self, job_id) -> Notifier:
+        notifier = self.job_notifiers.get(job_id)
+        if notifier is None:
+            notifier = self.job_notifiers.setdefault(job_id, Notifier())
+        return notifier
+
+    def lock_stats(self):
+        return self.locks.stats()
+
+    def gauges(self):
+        """
+        Queue depth, for metrics.
         """
-        return FileLock(self.root / job_id / "lock.txt")
+        todo = pending = 0
+        for job in list(self.jobs.values()):
+            todo += len(job.todo)
+            pending += len(job.pending)
+        with self.scheduler_lock:
+            scheduled = len(self.scheduler.jobs)
+        return {
+            "jobs_active": len(self.jobs),
+            "jobs_scheduled": scheduled,
+            "frames_todo": todo,
+            "frames_pending": pending,
+        }
+
+    def job(self, job_id) -> JobState | None:
+        """
+        Job state, loading finished jobs from disk if needed.
+        :return: None if job doesn't exist.
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+
+        with self.finished_lock:
+            job = self.finished.get(job_id)
+            if job is not None:
+                self.finished.move_to_end(job_id)
+                return job
+            if not self.index.exists(job_id) or not (self.root / job_id / "status.pkl").exists():
+                return None
+
+            job = self.jobs.get(job_id)
+            if job is None:
+                job = JobState.load(self.root / job_id, self.metrics)
+                self.cache_finished(job_id, job)
+            return job
+
+    def cache_finished(self, job_id, job):
+        """
+        Caller holds `finished_lock`.
+        """
+        self.finished[job_id] = job
+        while len(self.finished) > self.finished_cache_size:
+            old_id, old = self.finished.popitem(last=False)
+            old.close()
+            with self.stores_lock:
+                store = self.stores.pop(old_id, None)
+            if store is not None:
+                store.close()
+            self.locks.remove(old_id)
+            notifier = self.job_notifiers.pop(old_id, None)
+            if notifier is not None:
+                # Waiters poll again and get a new notifier if the job changes.
+                notifier.notify()
+
+    def finish_job(self, job_id):
+        """
+        Move job out of the hot set once all frames are done. Caller holds the job lock.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job.snapshot()
+        self.index.finish(job_id)
+        # Release file handles kept for writing; reads still work.
+        self.store(job_id).close()
+        with self.finished_lock:
+            self.cache_finished(job_id, job)
+            del self.jobs[job_id]
+
+    def store(self, job_id) -> RenderStore | None:
+        """
+        Render store of job, or None if job doesn't exist.
+        """
+        store = self.stores.get(job_id)
+        if store is not None:
+            return store
+        job = self.job(job_id)
+        if job is None:
+            return None
+        with self.stores_lock:
+            store = self.stores.get(job_id)
+            if store is None:
+                store = self.stores[job_id] = make_store(self.root / job_id / "renders",
+                    job.info.get("format", "JPEG"), job.info.get("packed", False))
+        return store
+
+    def render_file(self, job_id, frame):
+        """
+        File with the data of one rendered frame, copied out of the store if it packs frames.
+        :return: (path, temporary), or (None, False) if not rendered.
+            If temporary, the caller removes the file.
+        """
+        store = self.store(job_id)
+        if store is None or not store.has(frame):
+            return None, False
+        if store.path(frame) is not None:
+            return store.path(frame), False
+        path = self.temp_path(f".{store.ext}")
+        with path.open("wb") as f:
+            store.copy_to(frame, f)
+        return path, True
+
+    def schedule(self, job_id):
+        """
+        Add job to or remove it from the scheduler, depending on whether it has frames to give out.
+        Caller holds the job lock (or the job isn't shared yet).
+        """
+        job = self.job(job_id)
+        with self.scheduler_lock:
+            if job.todo:
+                self.scheduler.add(job_id, job.info)
+            else:
+                self.scheduler.remove(job_id)
 
-    def create_job(self, blend: bytes, frames: list[int], is_tar: bool):
+    def create_job(self, blend: bytes | Path, frames: FrameSet, is_tar: bool, options=None):
         """
         Creates new render job.
-        :param blend: Bytes data of blend file.
+        :param blend: Bytes data of blend file, or path to a finished upload
+            (which is moved into the job).
         :param frames: Frames to render.
+        :param options: Optional job info:
+            - "priority", "user", "deadline": Used by the scheduler.
+            - "tiles": Split each frame into this many tiles, see `tiles.py`.
+            - "format": Output format, a key of `storage.FORMATS`. Default "JPEG".
+            - "packed": Store renders in segment files instead of a file per frame.
         :return: Job ID (string)
         """
-        job_id = self.get_unique_id()
+        job_id = self.index.allocate(*(self.shard or ()))
         job_path = self.root / job_id
         job_path.mkdir()
 
         with self.lock(job_id):
             # Save blend file
-            if is_tar:
+            if isinstance(blend, Path):
+                if is_tar:
+                    blend.replace(job_path / "blend.tar.gz")
+                else:
+                    with blend.open("rb") as f:
+                        wrap_blend(f, blend.stat().st_size, job_path / "blend.tar.gz")
+                    blend.unlink()
+            elif is_tar:
                 (job_path / "blend.tar.gz").write_bytes(blend)
             else:
-                with tempfile.NamedTemporaryFile("wb") as f, tarfile.open(job_path / "blend.tar.gz", "w:gz") as tar:
-                    f.write(blend)
-                    f.flush()
-                    tar.add(f.name, arcname="main.blend")
-
-            # Write frame data.
-            data = {
-                "done": [],
-                "pending": {},   # {frame: time_start, ...}
-                "todo": sorted(list(frames)),
-                "batch_size": {},
-                "last_batch_update": {},
-                "last_status_update": {},
-            }
-            (job_path / "status.pkl").write_bytes(pickle.dumps(data))
+                wrap_blend(io.BytesIO(blend), len(blend), job_path / "blend.tar.gz")
 
             # Output renders directory.
             (job_path / "renders").mkdir()
+            if (options or {}).get("tiles", 1) > 1:
+                (job_path / "renders" / "tiles").mkdir()
 
+            # Write frame data.
+            info = dict(options or {})
+            info["blend_hash"] = file_hash(job_path / "blend.tar.gz")
+            # Registered before status.pkl exists, so `job()` never loads it as a finished job.
+            job = self.jobs[job_id] = JobState(job_path, frames, info, self.metrics)
+            job.snapshot()
+            self.schedule(job_id)
+
+        self.work_notifier.notify()
         return job_id
 
-    def get_work(self, worker_id):
+    def create_job_from_manifest(self, manifest, frames: FrameSet, options=None):
         """
-        Randomly chooses pending job to do.
-        :return: (job_id, frame)
+        Creates new render job from files in the chunk store.
+        :param manifest: [[relpath, [chunk_hash, ...]], ...], see `chunkstore.make_manifest`.
+        :param options: See `create_job`.
+        :return: Job ID, or None if manifest is invalid or chunks are missing.
         """
-        curr_jobs = list(self.get_pending_jobs())
-        if not curr_jobs:
-            return None, None
+        manifest = [[relpath.decode(), list(hashes)] for relpath, hashes in manifest]
+        if not any(relpath == "main.blend" for relpath, _ in manifest):
+            return None
+        for relpath, hashes in manifest:
+            if not valid_relpath(relpath) or not all(valid_hash(h) for h in hashes):
+                return None
+            if self.chunks.missing(hashes):
+                return None
+
+        tmp_path = self.temp_path()
+        self.chunks.build_archive(manifest, tmp_path)
+        job_id = self.create_job(tmp_path, frames, True, options)
+        write_atomic(self.root / job_id / "manifest.pkl", pickle.dumps(manifest))
+        return job_id
 
-        job_id = random.choice(curr_jobs)
+    def blend_path(self, job_id):
+        """
+        Path of job's blend.tar.gz, rebuilding it from the chunk store if it was removed.
+        :return: Path, or None if job doesn't exist.
+        """
+        job = self.job(job_id)
+        if job is None:
+            return None
+        path = self.root / job_id / "blend.tar.gz"
+        if not path.exists():
+            with self.lock(job_id):
+                if not path.exists():
+                    manifest = pickle.loads((self.root / job_id / "manifest.pkl").read_bytes())
+                    tmp_path = path.with_name("blend.tar.gz.tmp")
+                    self.chunks.build_archive(manifest, tmp_path)
+                    tmp_path.replace(path)
+        return path
+
+    def release_blend(self, job_id):
+        """
+        Remove blend.tar.gz of a finished job created from chunks; its files
+        stay in the chunk store, so server disk use doesn't grow per job.
+        Caller holds the job lock.
+        """
         job_path = self.root / job_id
+        if (job_path / "manifest.pkl").exists():
+            (job_path / "blend.tar.gz").unlink(missing_ok=True)
+            (job_path / "blend.tar.gz.crc").unlink(missing_ok=True)
 
-        with self.lock(job_id):
-            status = pickle.loads((job_path / "status.pkl").read_bytes())
+    def blend_hash(self, job_id):
+        """
+        :return: Content hash of job's blend.tar.gz, or None if job doesn't exist.
+        """
+        job = self.job(job_id)
+        return None if job is None else job.info["blend_hash"]
 
-            if worker_id not in status["batch_size"]:
-                # Initialize worker batch_size
-                status["batch_size"][worker_id] = 1
-                status["last_batch_update"][worker_id] = time.time()
+    def temp_path(self, suffix=""):
+        """
+        :return: Unused path in the uploads directory, for temporary files.
+        """
+        return self.upload_dir / f"{secrets.token_hex(8)}{suffix}"
 
-            # Check last_status_update timeout
-            for frame in list(status["last_status_update"].keys()):
-                if time.time() - status["last_status_update"][frame] > self.status_update_timeout:
-                    status["pending"].pop(frame)
-                    status["last_status_update"].pop(frame)
-                    status["todo"].append(frame)
-                    print(f"Status update timeout: JobID={job_id}, Frame={frame}")
+    def assemble_tiles(self, job_id, frames):
+        """
+        Paste together frames whose tiles are all done. Caller holds the job lock.
+        """
+        job = self.job(job_id)
+        tile_count = job.tiles()
+        tile_dir = self.root / job_id / "renders" / "tiles"
+
+        assembled = []
+        for frame in sorted(frames):
+            units = tiles.frame_units(frame, tile_count)
+            if all(unit in job.done_set for unit in units):
+                paths = [tile_dir / f"{unit}.png" for unit in units]
+                data = io.BytesIO()
+                tiles.assemble(paths, data, job.info.get("format", "JPEG"))
+                self.store(job_id).write(frame, data.getvalue())
+                for path in paths:
+                    path.unlink()
+                assembled.append(frame)
+        if assembled:
+            job.record("assembled", assembled)
+
+    def get_work(self, worker_id, blend_hashes=(), speculate=True):
+        """
+        Claims frames of the job chosen by the scheduler.
+        :param blend_hashes: Blends the worker has cached, for cache affinity.
+        :param speculate: If no job has frames to claim, fall back to `speculate`.
+        :return: (job_id, frames), or (None, None) if there is no work.
+        """
+        self.metrics.worker_seen(worker_id)
+        self.requeue_timed_out()
+
+        while True:
+            with self.scheduler_lock:
+                job_id = self.scheduler.pick(worker_id, blend_hashes)
+            if job_id is None:
+                return self.speculate(worker_id) if speculate else (None, None)
+            job = self.job(job_id)
+
+            with self.lock(job_id):
+                now = time.time()
+
+                # Update frames
+                count = min(self.batch_size(job, worker_id), len(job.todo))
+                frames = job.todo.first(count)
+                # Older versions left frames in todo that completed after a requeue.
+                if any(frame in job.done_set for frame in frames):
+                    job.record("complete", [frame for frame in frames if frame in job.done_set])
+                    frames = [frame for frame in frames if frame not in job.done_set]
+                if frames:
+                    job.record("claim", worker_id, frames, now)
+                    with self.scheduler_lock:
+                        self.scheduler.claimed(job_id, worker_id, len(frames))
+                # Another worker may have taken the last frames since `pick`.
+                self.schedule(job_id)
+
+            if frames:
+                return (job_id, frames)
+
+    def speculate(self, worker_id):
+        """
+        Give an idle worker a copy of the most overdue straggler frame, from jobs
+        with no frames left to claim. Whichever copy is uploaded first is kept;
+        the other worker is told to cancel through its status updates.
 
-            # Update frames
-            frames = status["todo"][:int(status["batch_size"][worker_id])]
-            for frame in frames:
-                status["todo"].remove(frame)
-                status["pending"][frame] = time.time()
-                status["last_status_update"][frame] = time.time()
+        Frames of a worker's batch render in order, so the i-th pending frame of
+        a worker is expected i+1 frame times after its last completed frame.
+        :return: (job_id, [frame]), or (None, None).
+        """
+        now = time.time()
+        best = None   # (overdue ratio, job_id, frame)
+        for job_id, job in list(self.jobs.items()):
+            if job.todo or not job.pending:
+                continue
+            with self.read_lock(job_id):
+                by_owner = {}
+                for frame in job.pending:
+                    by_owner.setdefault(job.owner.get(frame), []).append(frame)
+                for owner, frames in by_owner.items():
+                    est = job.timing.get(owner, job.frame_time)
+                    if owner == worker_id or est.n == 0:
+                        continue
+                    limit = max(est.mean + 3*est.std(), self.speculate_factor * est.mean)
+                    for i, frame in enumerate(sorted(frames, key=job.pending.get)):
+                        if frame in job.speculated:
+                            continue
+                        started = max(job.pending[frame], self.last_complete.get((job_id, owner), 0))
+                        ratio = (now - started) / ((i+1) * limit)
+                        if ratio > 1 and (best is None or ratio > best[0]):
+                            best = (ratio, job_id, frame)
+
+        if best is None:
+            return None, None
+        _, job_id, frame = best
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None, None
+        with self.lock(job_id):
+            if frame not in job.pending or frame in job.speculated:
+                return None, None
+            job.speculated[frame] = worker_id
+        print(f"Speculating straggler: JobID={job_id}, Frame={frame}, WorkerID={worker_id}")
+        return job_id, [frame]
+
+    def batch_size(self, job, worker_id):
+        """
+        Frames that take the worker about `tgt_batch_time`, using the first estimate that exists of:
+        this worker on this job, all workers on this job, this worker on any job.
+        Near the end of the job, remaining frames are split evenly between workers
+        so nobody is left rendering a long batch alone.
+        Caller holds the job lock.
+        """
+        est = job.timing.get(worker_id)
+        if est is None:
+            est = job.frame_time if job.frame_time.n > 0 else self.timing.get(self.worker_names.get(worker_id))
 
-            (job_path / "status.pkl").write_bytes(pickle.dumps(status))
+        size = 1
+        if est is not None and est.n > 0:
+            # Pessimistic estimate, so batches of noisy scenes don't overshoot.
+            size = self.tgt_batch_time / max(est.mean + est.std(), 1e-3)
 
-        return (job_id, frames)
+        workers = max(1, len(job.timing))
+        tail = math.ceil(len(job.todo) / workers)
+        return int(max(1, min(self.max_batch_size, size, tail)))
+
+    def timing_info(self, job_id=None):
+        """
+        :return: {"workers": {name: {...}}, "job": {...}}, see `Estimate.to_dict`.
+            "job" is only present with job_id: {"all": {...}, "workers": {worker_id: {...}}}.
+        """
+        info = {"workers": self.timing.to_dict()}
+        job = None if job_id is None else self.job(job_id)
+        if job is not None:
+            with self.read_lock(job_id):
+                info["job"] = {
+                    "all": job.frame_time.to_dict(),
+                    "workers": {worker_id: est.to_dict() for worker_id, est in job.timing.items()},
+                }
+        return info
+
+    def requeue_timed_out(self):
+        """
+        Move pending frames whose worker stopped sending status updates back to "todo".
+        """
+        now = time.time()
+        requeued = False
+        for job_id, job in list(self.jobs.items()):
+            if not job.last_status_update:
+                continue
+            with self.lock(job_id):
+                timed_out = [frame for frame, t in job.last_status_update.items()
+                    if now - t > self.status_update_timeout]
+                if timed_out:
+                    job.record("requeue", timed_out)
+                    self.schedule(job_id)
+                    requeued = True
+                    print(f"Status update timeout: JobID={job_id}, Frames={timed_out}")
+
+        if requeued:
+            self.work_notifier.notify()
 
     def save_render(self, worker_id, job_id, frame, img_data):
+        return self.save_renders(worker_id, job_id, {frame: img_data})
+
+    def save_renders(self, worker_id, job_id, renders, times=None):
+        """
+        Save rendered frames with one state commit.
+        :param renders: {frame: img_data}
+        :param times: {frame: seconds} render time of each frame, as measured by the worker.
+            If missing, estimated from when the frames were claimed.
+        :return: False if job doesn't exist.
+        """
         job_path = self.root / job_id
+        job = self.job(job_id)
+        if job is None:
+            return False
 
         with self.lock(job_id):
-            status = pickle.loads((job_path / "status.pkl").read_bytes())
-
-            # WORKAROUND: Currently, worker uploads batch one frame at a time.
-            # If we update `batch_size` every frame, it will be updated as many
-            # times as there are frames in the batch.
-            # Instead, the timeout ensures each batch only creates one update.
-            time_since_update = time.time() - status["last_batch_update"][worker_id]
-            if time_since_update > 10:
-                avg_time = (time.time() - status["pending"][frame]) / status["batch_size"][worker_id]
-                nominal_bs = self.tgt_batch_time / avg_time
-                diff = nominal_bs - status["batch_size"][worker_id]
-                new_bs = status["batch_size"][worker_id] + diff*0.5
-                new_bs = max(1, min(self.max_batch_size, new_bs))
-                status["batch_size"][worker_id] = new_bs
-
-                status["last_batch_update"][worker_id] = time.time()
+            now = time.time()
+
+            new_frames = [frame for frame in renders if frame in job.pending]
+            if times is None and new_frames:
+                start = max(min(job.pending[frame] for frame in new_frames),
+                    self.last_complete.get((job_id, worker_id), 0))
+                times = dict.fromkeys(new_frames, (now - start) / len(new_frames))
+            self.last_complete[(job_id, worker_id)] = now
+            for frame in new_frames:
+                if frame in times:
+                    job.record("frame_time", worker_id, times[frame])
+                    self.timing.add(self.worker_names.get(worker_id), times[frame])
+            self.metrics.worker_frames(worker_id, len(new_frames),
+                sum(times.get(frame, 0) for frame in new_frames))
+
+            # Save images. First result wins if a frame was speculated.
+            tile_count = job.tiles()
+            renders = {frame: img_data for frame, img_data in renders.items() if frame not in job.done_set}
+            with self.metrics.timed("render_write"):
+                for frame, img_data in renders.items():
+                    if tile_count == 1:
+                        self.store(job_id).write(frame, img_data)
+                    else:
+                        (job_path / "renders" / "tiles" / f"{frame}.png").write_bytes(img_data)
 
             # Update frames
-            status["pending"].pop(frame)
-            status["last_status_update"].pop(frame)
-            status["done"].append(frame)
+            if not renders:
+                return True
+            job.record("complete", list(renders))
+            if tile_count > 1:
+                self.assemble_tiles(job_id, {tiles.unit_frame(unit, tile_count) for unit in renders})
+            if not job.todo and not job.pending:
+                self.release_blend(job_id)
+                self.finish_job(job_id)
+                for key in [key for key in self.last_complete if key[0] == job_id]:
+                    del self.last_complete[key]
+
+        self.job_notifier(job_id).notify()
+        return True
+
+    def job_events(self, job_id, cursor):
+        """
+        Frames completed since `cursor`, in completion order.
+        :param cursor: Number of completed frames the caller already has.
+        :return: (frames, finished, version), or None if job doesn't exist.
+            frames: FrameLog.
+            version: Of the job's notifier, read before the frames; wait on it for more.
+        """
+        job = self.job(job_id)
+        if job is None:
+            return None
 
-            # Save image
-            (job_path / "renders" / f"{frame}.jpg").write_bytes(img_data)
+        version = self.job_notifier(job_id).version
+        with self.read_lock(job_id):
+            frames = job.frames_done().since(cursor)
+            finished = not job.todo and not job.pending
+        return frames, finished, version
 
-            (job_path / "status.pkl").write_bytes(pickle.dumps(status))
+    def read_renders(self, job_id, frames: FrameLog, max_bytes, max_frames=None):
+        """
+        Read render data of completed frames.
+        :param max_bytes: Stop adding frames after this much data (at least one frame is returned).
+        :param max_frames: If given, return at most this many frames.
+        :return: {frame: img_data}, a prefix of `frames`.
+        """
+        renders = {}
+        size = 0
+        with self.metrics.timed("render_read"):
+            for frame in frames:
+                if renders and size >= max_bytes or len(renders) == max_frames:
+                    break
+                renders[frame] = self.store(job_id).read(frame)
+                size += len(renders[frame])
+        return renders
 
     def status_update(self, job_id, frames):
-        job_path = self.root / job_id
+        """
+        :return: Frames the worker should stop rendering, because they were completed
+            by another worker.
+        """
+        job = self.job(job_id)
+        if job is None:
+            return list(frames)
 
         with self.lock(job_id):
-            status = pickle.loads((job_path / "status.pkl").read_bytes())
-
+            now = time.time()
             for frame in frames:
-                status["last_status_update"][frame] = time.time()
-
-            (job_path / "status.pkl").write_bytes(pickle.dumps(status))
-
-    def get_unique_id(self):
-        max_num = 0
-        for f in self.root.iterdir():
-            name = f.stem
-            if name.isdigit():
-                max_num = max(max_num, int(name)+1)
-        return str(max_num)
+                if frame in job.pending:
+                    job.last_status_update[frame] = now
+            return [frame for frame in frames if frame in job.done_set]
 
-    def get_pending_jobs(self):
+    def job_status(self, job_id):
         """
-        Job IDs that have frames available to give to workers.
+        :return: (frames_done, frames_requested) in the wire format of `frameset.py`,
+            or None if job doesn't exist. frames_done is in completion order.
         """
-        for jobdir in self.root.iterdir():
-            done_txt = (jobdir / "done.txt")
-            if not done_txt.exists():
-                frames = pickle.loads((jobdir / "status.pkl").read_bytes())
-                if len(frames["todo"]) > 0:
-                    yield jobdir.name
-                else:
-                    # Mark as done, won't check next time.
-                    (jobdir / "done.txt").touch()
+        job = self.job(job_id)
+        if job is None:
+            return None
+
+        with self.read_lock(job_id):
+            return job.frames_done().encode(), job.frames.encode()
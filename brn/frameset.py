@@ -0,0 +1,294 @@
+"""
+Compact sets and sequences of frames, stored as runs of evenly spaced frames.
+
+Wire format (also used in status.pkl): a list whose items are either a frame
+(int), or a run [start, stop] or [start, stop, step] with the meaning of
+Python's `range`. A plain list of frames is valid, so old clients still work.
+    [1, [10, 20], [100, 1000, 2]]   # 1, 10..19, 100, 102, ..., 998
+"""
+
+from bisect import bisect_right
+
+
+def decode(data):
+    """
+    Frames of wire format data, in order.
+    """
+    for item in data:
+        if isinstance(item, int):
+            yield item
+        else:
+            yield from range(*item)
+
+
+def encode(frames) -> list:
+    """
+    Wire format of frames, keeping their order.
+    """
+    return FrameLog(frames).encode()
+
+
+def encode_run(start, step, count) -> list:
+    """
+    Wire format items of `count` frames from `start` by `step`.
+    """
+    if count <= 2:
+        return [start + step*i for i in range(count)]
+    stop = start + step*count
+    return [[start, stop] if step == 1 else [start, stop, step]]
+
+
+class FrameSet:
+    """
+    Sorted set of frames, as runs of frames with a fixed step.
+    Runs don't overlap: each run ends before the next one starts.
+    Lookups and changes are O(log runs), plus moving list items when runs
+    are split or joined. Frames between the members of a run (e.g. even frames
+    added to a set of odd ones) are kept as single frames.
+    """
+
+    def __init__(self, frames=()):
+        # Run i: frames starts[i], starts[i] + steps[i], ..., lasts[i]
+        self._starts = []
+        self._lasts = []
+        self._steps = []
+        self._len = 0
+        if isinstance(frames, range):
+            self.add_range(frames.start, frames.stop, frames.step)
+        else:
+            self.update(frames)
+
+    @classmethod
+    def decode(cls, data):
+        frames = cls()
+        for item in data:
+            if isinstance(item, int):
+                frames.add(item)
+            else:
+                frames.add_range(*item)
+        return frames
+
+    def encode(self) -> list:
+        data = []
+        for start, last, step in zip(self._starts, self._lasts, self._steps):
+            data.extend(encode_run(start, step, (last-start) // step + 1))
+        return data
+
+    def copy(self):
+        frames = FrameSet()
+        frames._starts = list(self._starts)
+        frames._lasts = list(self._lasts)
+        frames._steps = list(self._steps)
+        frames._len = self._len
+        return frames
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for start, last, step in zip(self._starts, self._lasts, self._steps):
+            yield from range(start, last+1, step)
+
+    def __contains__(self, frame):
+        i = bisect_right(self._starts, frame) - 1
+        return i >= 0 and frame <= self._lasts[i] and (frame - self._starts[i]) % self._steps[i] == 0
+
+    def __repr__(self):
+        return f"FrameSet({self.encode()})"
+
+    def first(self, count) -> list[int]:
+        """
+        Smallest `count` frames.
+        """
+        frames = []
+        for start, last, step in zip(self._starts, self._lasts, self._steps):
+            if len(frames) >= count:
+                break
+            frames.extend(range(start, last+1, step)[:count - len(frames)])
+        return frames
+
+    def add(self, frame):
+        i = bisect_right(self._starts, frame) - 1
+        if i >= 0 and frame <= self._lasts[i]:
+            start, last, step = self._starts[i], self._lasts[i], self._steps[i]
+            if (frame - start) % step == 0:
+                return
+            # Inside the run's span but not in it: split the run around frame.
+            below = start + (frame - start) // step * step
+            self._lasts[i] = below
+            self._insert(i+1, frame, frame, 1)
+            self._insert(i+2, below + step, last, step)
+            self._len += 1
+            return
+
+        i += 1
+        self._insert(i, frame, frame, 1)
+        self._len += 1
+        # Prefer extending a run to pairing up single frames.
+        if i > 0 and not self._single(i-1) and self._joinable(i-1):
+            self._join(i-1)
+            i -= 1
+        elif i+1 < len(self._starts) and not self._single(i+1) and self._joinable(i):
+            self._join(i)
+        elif i > 0 and self._joinable(i-1):
+            self._join(i-1)
+            i -= 1
+        elif i+1 < len(self._starts) and self._joinable(i):
+            self._join(i)
+        else:
+            return
+        # The grown run may now meet its other neighbour.
+        for j in (i-1, i):
+            if 0 <= j and j+1 < len(self._starts) and self._joinable(j):
+                self._join(j)
+                break
+
+    def add_range(self, start, stop, step=1):
+        frames = range(start, stop, step)
+        if step < 0:
+            frames = frames[::-1]
+        if len(frames) <= 2 or (self._starts and frames[0] <= self._lasts[-1]):
+            for frame in frames:
+                self.add(frame)
+            return
+        self._insert(len(self._starts), frames[0], frames[-1], frames.step)
+        self._len += len(frames)
+        if len(self._starts) > 1 and self._joinable(len(self._starts) - 2):
+            self._join(len(self._starts) - 2)
+
+    def update(self, frames):
+        if isinstance(frames, FrameSet):
+            for start, last, step in zip(frames._starts, frames._lasts, frames._steps):
+                self.add_range(start, last+1, step)
+        else:
+            for frame in frames:
+                self.add(frame)
+
+    def discard(self, frame):
+        if frame not in self:
+            return
+        i = bisect_right(self._starts, frame) - 1
+        start, last, step = self._starts[i], self._lasts[i], self._steps[i]
+        if start == last:
+            del self._starts[i], self._lasts[i], self._steps[i]
+        elif frame == start:
+            self._starts[i] += step
+        elif frame == last:
+            self._lasts[i] -= step
+        else:
+            self._lasts[i] = frame - step
+            self._insert(i+1, frame + step, last, step)
+        self._len -= 1
+
+    def _insert(self, i, start, last, step):
+        self._starts.insert(i, start)
+        self._lasts.insert(i, last)
+        self._steps.insert(i, step)
+
+    def _single(self, i):
+        return self._starts[i] == self._lasts[i]
+
+    def _joinable(self, i):
+        """
+        Whether runs i and i+1 form one run.
+        """
+        gap = self._starts[i+1] - self._lasts[i]
+        return (self._single(i) or self._steps[i] == gap) and \
+            (self._single(i+1) or self._steps[i+1] == gap)
+
+    def _join(self, i):
+        self._steps[i] = self._starts[i+1] - self._lasts[i]
+        self._lasts[i] = self._lasts[i+1]
+        del self._starts[i+1], self._lasts[i+1], self._steps[i+1]
+
+
+class FrameLog:
+    """
+    Append-only sequence of frames (e.g. in completion order), as runs of
+    frames with a fixed step.
+    """
+
+    def __init__(self, frames=()):
+        # Run i: counts[i] frames from starts[i] by steps[i]; offsets[i] is its index in the sequence.
+        self._starts = []
+        self._steps = []
+        self._counts = []
+        self._offsets = []
+        self._len = 0
+        self.extend(frames)
+
+    @classmethod
+    def decode(cls, data):
+        log = cls()
+        for item in data:
+            if isinstance(item, int):
+                log.append(item)
+            else:
+                frames = range(*item)
+                if len(frames) <= 2:
+                    log.extend(frames)
+                elif log._counts and log._counts[-1] > 1 and log._steps[-1] == frames.step and \
+                        log._starts[-1] + log._steps[-1] * log._counts[-1] == frames[0]:
+                    log._counts[-1] += len(frames)
+                    log._len += len(frames)
+                else:
+                    log._add_run(frames[0], frames.step, len(frames))
+        return log
+
+    def encode(self) -> list:
+        data = []
+        for start, step, count in zip(self._starts, self._steps, self._counts):
+            data.extend(encode_run(start, step, count))
+        return data
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for start, step, count in zip(self._starts, self._steps, self._counts):
+            yield from range(start, start + step*count, step)
+
+    def __repr__(self):
+        return f"FrameLog({self.encode()})"
+
+    def append(self, frame):
+        if self._counts:
+            start, step, count = self._starts[-1], self._steps[-1], self._counts[-1]
+            if count == 1 and frame != start:
+                self._steps[-1] = frame - start
+                self._counts[-1] = 2
+                self._len += 1
+                return
+            if count > 1 and frame == start + step*count:
+                self._counts[-1] += 1
+                self._len += 1
+                return
+        self._add_run(frame, 1, 1)
+
+    def extend(self, frames):
+        for frame in frames:
+            self.append(frame)
+
+    def since(self, index):
+        """
+        :return: FrameLog of the frames from `index` on.
+        """
+        log = FrameLog()
+        if index >= self._len:
+            return log
+        i = max(bisect_right(self._offsets, index) - 1, 0)
+        skip = max(index - self._offsets[i], 0)
+        for j in range(i, len(self._starts)):
+            log._add_run(self._starts[j] + self._steps[j]*skip, self._steps[j], self._counts[j] - skip)
+            skip = 0
+        return log
+
+    def _add_run(self, start, step, count):
+        self._starts.append(start)
+        self._steps.append(step)
+        self._counts.append(count)
+        self._offsets.append(self._len)
+        self._len += count
@@ -0,0 +1,81 @@
+"""
+On-disk index of all jobs, so startup and job creation don't scan the jobs directory.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class JobIndex:
+    """
+    SQLite table of jobs and whether they are finished.
+    IDs come from an AUTOINCREMENT key, so allocation is atomic (also across
+    server processes sharing the root) and IDs are never reused.
+
+    File: root / "index.db"
+    An existing root without an index is imported once, with all jobs active;
+    DataManager marks the finished ones as it loads them.
+    """
+
+    def __init__(self, root):
+        root = Path(root)
+        path = root / "index.db"
+        new = not path.exists()
+
+        self.mutex = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, finished REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS active_jobs ON jobs (id) WHERE finished IS NULL")
+
+        if new:
+            self.import_dirs(root)
+
+    def import_dirs(self, root):
+        now = time.time()
+        rows = [(int(path.name), now) for path in root.iterdir() if path.name.isdigit()]
+        with self.mutex:
+            self.db.executemany("INSERT OR IGNORE INTO jobs (id, created) VALUES (?, ?)", rows)
+
+    def allocate(self, shard=0, shards=1) -> str:
+        """
+        :param shard, shards: Only allocate IDs equal to shard modulo shards, see `shard.py`.
+        :return: New job ID.
+        """
+        with self.mutex:
+            if shards == 1:
+                cursor = self.db.execute("INSERT INTO jobs (created) VALUES (?)", (time.time(),))
+            else:
+                # Smallest ID of the shard above all used IDs. One statement, so other
+                # processes can't take it between reading and inserting.
+                cursor = self.db.execute("INSERT INTO jobs (id, created) "
+                    "SELECT next + (? - next % ? + ?) % ?, ? "
+                    "FROM (SELECT COALESCE(MAX(id), 0) + 1 AS next FROM jobs)",
+                    (shard, shards, shards, shards, time.time()))
+        return str(cursor.lastrowid)
+
+    def finish(self, job_id):
+        with self.mutex:
+            self.db.execute("UPDATE jobs SET finished = ? WHERE id = ?", (time.time(), int(job_id)))
+
+    def active(self) -> list[str]:
+        """
+        IDs of jobs not finished yet.
+        """
+        with self.mutex:
+            rows = self.db.execute("SELECT id FROM jobs WHERE finished IS NULL").fetchall()
+        return [str(job_id) for job_id, in rows]
+
+    def exists(self, job_id) -> bool:
+        if not job_id.isdigit() or len(job_id) > 18:
+            return False
+        with self.mutex:
+            row = self.db.execute("SELECT 1 FROM jobs WHERE id = ?", (int(job_id),)).fetchone()
+        return row is not None
+
+    def close(self):
+        with self.mutex:
+            self.db.close()
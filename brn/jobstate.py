@@ -0,0 +1,275 @@
+import os
+import pickle
+import time
+from pathlib import Path
+
+from . import tiles
+from .frameset import FrameLog, FrameSet
+from .timing import Estimate
+
+
+def write_atomic(path, data):
+    """
+    Replace file contents durably: after a crash the file has either the old or
+    the new contents, never a mix.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp_path.replace(path)
+    if hasattr(os, "O_DIRECTORY"):
+        # Make the rename itself durable.
+        fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class JobState:
+    """
+    Authoritative in-memory state of one job.
+    DataManager mutates this directly; disk is only written through the journal
+    and periodic snapshots, never read back on the request path.
+
+    Persistence:
+    - status.pkl: Snapshot of `to_dict()`, replaced atomically (see `write_atomic`).
+    - journal.pkl: Stream of pickled records applied after the snapshot.
+        Each record is a tuple `(op, *args)`; see `apply()`. The first record is
+        ("generation", n), matching the snapshot it follows.
+    Every `snapshot_interval` records, the snapshot is rewritten and the journal truncated.
+    A crash between the two leaves a journal of an older generation, which is ignored.
+
+    Journal records are flushed, not fsynced: a server crash loses none, a power loss
+    may lose the last few. Those frames are then rendered again, as their state on
+    disk is still from before they were completed.
+    """
+
+    snapshot_interval = 1000
+
+    def __init__(self, path, frames=(), info=None, metrics=None):
+        """
+        :param frames: Frames to render; expanded to work units if info["tiles"] > 1.
+        :param metrics: If given, journal and snapshot writes are timed, see `Metrics.timed`.
+        """
+        self.path = Path(path)
+        self.metrics = metrics
+        # Job metadata fixed at creation, e.g. "blend_hash".
+        self.info = dict(info or {})
+
+        # Frames requested.
+        self.frames = frames if isinstance(frames, FrameSet) else FrameSet(frames)
+        tile_count = self.tiles()
+        if tile_count == 1:
+            self.todo = self.frames.copy()
+        else:
+            self.todo = FrameSet(unit for frame in self.frames for unit in tiles.frame_units(frame, tile_count))
+        self.pending = {}   # {frame: time_start, ...}
+        self.owner = {}   # {frame: worker_id} of pending frames
+        self.done = FrameLog()   # in completion order
+        self.done_set = FrameSet()
+        # Frames whose tiles were all done and pasted together; only used if tiles > 1.
+        self.assembled = FrameLog()
+        self.timing = {}   # {worker_id: Estimate}
+        self.frame_time = Estimate()   # over all workers
+        self.last_status_update = {}
+        # Pending frames also given to another worker: {frame: worker_id}. Not persisted.
+        self.speculated = {}
+
+        # Number of snapshots written, to tell whether the journal belongs to the snapshot.
+        self.generation = 0
+        self._journal = None
+        self._journal_len = 0
+
+    @classmethod
+    def create(cls, path, frames, info=None, metrics=None):
+        job = cls(path, frames, info, metrics)
+        job.snapshot()
+        return job
+
+    @classmethod
+    def load(cls, path, metrics=None):
+        """
+        Load snapshot and replay journal.
+        Heartbeats are not journaled, so every pending frame gets a fresh status
+        update time; frames from dead workers then time out as usual.
+        """
+        job = cls(path, metrics=metrics)
+        job.from_dict(pickle.loads((job.path / "status.pkl").read_bytes()))
+
+        replayed = 0
+        current = False   # journal starts with this snapshot's generation
+        journal_path = job.path / "journal.pkl"
+        if journal_path.exists():
+            with journal_path.open("rb") as f:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except Exception:
+                        # A truncated trailing record is a write that never finished.
+                        break
+                    if record[0] == "generation":
+                        current = record[1] == job.generation
+                        if not current:
+                            # Already contained in the snapshot.
+                            break
+                        continue
+                    job.apply(*record)
+                    replayed += 1
+
+        now = time.time()
+        for frame in job.pending:
+            job.last_status_update[frame] = now
+
+        # Otherwise new records would be appended to a journal the next load ignores.
+        if replayed or not current:
+            job.snapshot()
+        return job
+
+    def to_dict(self):
+        """
+        Frame sets are in the wire format of `frameset.py`.
+        """
+        return {
+            "info": dict(self.info),
+            "frames": self.frames.encode(),
+            "done": self.done.encode(),
+            "done_set": self.done_set.encode(),
+            "assembled": self.assembled.encode(),
+            "pending": dict(self.pending),
+            "owner": dict(self.owner),
+            "todo": self.todo.encode(),
+            "timing": {worker_id: est.to_tuple() for worker_id, est in self.timing.items()},
+            "frame_time": self.frame_time.to_tuple(),
+            "last_status_update": dict(self.last_status_update),
+            "generation": self.generation,
+        }
+
+    def from_dict(self, data):
+        self.info = dict(data.get("info", {}))
+        # Older snapshots have plain lists, which decode the same.
+        self.todo = FrameSet.decode(data["todo"])
+        self.pending = dict(data["pending"])
+        self.owner = dict(data.get("owner", {}))
+        self.done = FrameLog.decode(data["done"])
+        if "done_set" in data:
+            self.done_set = FrameSet.decode(data["done_set"])
+        else:
+            self.done_set = FrameSet(sorted(self.done))
+        # Older versions could leave a frame in todo that completed after a requeue.
+        for frame in [frame for frame in self.todo if frame in self.done_set]:
+            self.todo.discard(frame)
+        self.assembled = FrameLog.decode(data.get("assembled", []))
+        if "frames" in data:
+            self.frames = FrameSet.decode(data["frames"])
+        else:
+            units = sorted(set(self.done_set).union(self.pending, self.todo))
+            tile_count = self.tiles()
+            self.frames = FrameSet(sorted({tiles.unit_frame(unit, tile_count) for unit in units}))
+        self.timing = {worker_id: Estimate(*est) for worker_id, est in data.get("timing", {}).items()}
+        self.frame_time = Estimate(*data.get("frame_time", ()))
+        self.last_status_update = dict(data["last_status_update"])
+        self.generation = data.get("generation", 0)
+
+    def tiles(self):
+        """
+        Work units per frame; `todo`, `pending` and `done` hold units, see `tiles.py`.
+        """
+        return self.info.get("tiles", 1)
+
+    def frames_done(self) -> FrameLog:
+        """
+        Completed frames in completion order.
+        """
+        return self.done if self.tiles() == 1 else self.assembled
+
+    def apply(self, op, *args):
+        """
+        Apply one state change. Used both live (through `record()`) and on journal replay.
+        """
+        if op == "claim":
+            worker_id, frames, t = args
+            for frame in frames:
+                self.todo.discard(frame)
+                self.pending[frame] = t
+                self.owner[frame] = worker_id
+                self.last_status_update[frame] = t
+
+        elif op == "requeue":
+            frames, = args
+            for frame in frames:
+                self.pending.pop(frame, None)
+                self.owner.pop(frame, None)
+                self.last_status_update.pop(frame, None)
+                self.speculated.pop(frame, None)
+                self.todo.add(frame)
+
+        elif op == "complete":
+            frames, = args
+            for frame in frames:
+                # May have been requeued meanwhile, e.g. after a late upload.
+                self.todo.discard(frame)
+                self.pending.pop(frame, None)
+                self.owner.pop(frame, None)
+                self.speculated.pop(frame, None)
+                self.last_status_update.pop(frame, None)
+                if frame not in self.done_set:
+                    self.done_set.add(frame)
+                    self.done.append(frame)
+
+        elif op == "assembled":
+            frames, = args
+            self.assembled.extend(frames)
+
+        elif op == "frame_time":
+            worker_id, seconds = args
+            self.timing.setdefault(worker_id, Estimate()).add(seconds)
+            self.frame_time.add(seconds)
+
+        elif op == "batch_size":
+            # Written by older versions; batch sizes are now derived from `timing`.
+            pass
+
+        else:
+            raise ValueError(f"Unknown journal op {op}")
+
+    def record(self, op, *args):
+        """
+        Apply change and append it to the journal.
+        """
+        self.apply(op, *args)
+
+        t = time.perf_counter()
+        if self._journal is None:
+            self._journal = (self.path / "journal.pkl").open("ab")
+        pickle.dump((op, *args), self._journal)
+        self._journal.flush()
+        self._journal_len += 1
+        if self.metrics is not None:
+            self.metrics.observe_phase("journal", time.perf_counter() - t)
+
+        if self._journal_len >= self.snapshot_interval:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Write status.pkl and truncate journal.
+        """
+        t = time.perf_counter()
+        self.generation += 1
+        write_atomic(self.path / "status.pkl", pickle.dumps(self.to_dict()))
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        (self.path / "journal.pkl").write_bytes(pickle.dumps(("generation", self.generation)))
+        self._journal_len = 0
+        if self.metrics is not None:
+            self.metrics.observe_phase("snapshot", time.perf_counter() - t)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
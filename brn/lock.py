@@ -0,0 +1,279 @@
+"""
+Lock primitives used by DataManager.
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class LockStats:
+    """
+    Contention counters for one lock.
+    Times are in seconds.
+    """
+
+    def __init__(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0
+        self.max_wait = 0
+
+    def add(self, wait, contended):
+        self.acquisitions += 1
+        if contended:
+            self.contended += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def merge(self, other):
+        self.acquisitions += other.acquisitions
+        self.contended += other.contended
+        self.wait_time += other.wait_time
+        self.max_wait = max(self.max_wait, other.max_wait)
+
+    def to_dict(self):
+        """
+        Counters are decimal strings, see `metrics.exact`.
+        """
+        return {
+            "acquisitions": str(self.acquisitions),
+            "contended": str(self.contended),
+            "wait_time": str(self.wait_time),
+            "max_wait": self.max_wait,
+        }
+
+
+class FcntlLock:
+    """
+    Exclusive `flock` on a file, for servers running as multiple processes.
+    Not reentrant; always taken while holding the in-process lock, so only one
+    thread per process waits on it.
+    """
+
+    def __init__(self, path):
+        if fcntl is None:
+            raise RuntimeError("fcntl is not available on this platform.")
+        self.path = Path(path)
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = open(self.path, "a")
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+        self.fd = None
+
+
+class RWLock:
+    """
+    Readers-writer lock with writer preference.
+    Many readers may hold it at once; a writer waits for readers to leave and
+    blocks new readers while waiting, so a stream of `job_status` calls can't
+    starve `save_render`.
+
+    :param file_path: If given, writers also take an FcntlLock on this file.
+    """
+
+    def __init__(self, file_path=None):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+        self.file_lock = FcntlLock(file_path) if file_path is not None else None
+
+        self.read_stats = LockStats()
+        self.write_stats = LockStats()
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            contended = self.writer or self.writers_waiting > 0
+            t = time.perf_counter()
+            while self.writer or self.writers_waiting > 0:
+                self.cond.wait()
+            self.readers += 1
+            self.read_stats.add(time.perf_counter() - t, contended)
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            contended = self.writer or self.readers > 0
+            t = time.perf_counter()
+            self.writers_waiting += 1
+            while self.writer or self.readers > 0:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+            self.write_stats.add(time.perf_counter() - t, contended)
+
+        try:
+            if self.file_lock is not None:
+                with self.file_lock:
+                    yield
+            else:
+                yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class Notifier:
+    """
+    Version counter that threads or asyncio tasks can wait on to advance.
+    Used for long-polling: read `version`, check state, then `wait(version)`;
+    a change between the check and the wait is never missed.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.version = 0
+        self.async_waiters = []   # [(loop, future), ...]
+
+    def notify(self):
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+            waiters, self.async_waiters = self.async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_set_result, future)
+
+    def wait(self, version, timeout):
+        """
+        Block until version differs from `version`, or timeout.
+        :return: True if changed.
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.version != version, timeout)
+
+    async def wait_async(self, version, timeout):
+        """
+        Async counterpart of `wait`; doesn't block the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.cond:
+            if self.version != version:
+                return True
+            self.async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self.cond:
+                if (loop, future) in self.async_waiters:
+                    self.async_waiters.remove((loop, future))
+            return False
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LockRegistry:
+    """
+    One RWLock per key, created on first use and dropped by `remove`.
+    Each lock counts the threads using it, so it is never dropped while
+    one of them holds or waits for it.
+
+    :param file_dir: If given, use cross-process locks at `file_dir / key / "lock.txt"`.
+    """
+
+    def __init__(self, file_dir=None):
+        self.file_dir = None if file_dir is None else Path(file_dir)
+        self.locks: dict[str, RWLock] = {}
+        self.users: dict[str, int] = {}
+        self.removed = set()   # Keys to drop once their last user leaves.
+        self.mutex = threading.Lock()
+
+        # Counters of dropped locks.
+        self.read_stats = LockStats()
+        self.write_stats = LockStats()
+
+    @contextmanager
+    def use(self, key):
+        """
+        :return: Context holding on to the RWLock of key (without locking it).
+        """
+        with self.mutex:
+            lock = self.locks.get(key)
+            if lock is None:
+                file_path = None if self.file_dir is None else self.file_dir / key / "lock.txt"
+                lock = self.locks[key] = RWLock(file_path)
+            self.users[key] = self.users.get(key, 0) + 1
+            self.removed.discard(key)
+        try:
+            yield lock
+        finally:
+            with self.mutex:
+                self.users[key] -= 1
+                if self.users[key] == 0:
+                    del self.users[key]
+                    if key in self.removed:
+                        self.drop(key)
+
+    @contextmanager
+    def read(self, key):
+        with self.use(key) as lock, lock.read():
+            yield
+
+    @contextmanager
+    def write(self, key):
+        with self.use(key) as lock, lock.write():
+            yield
+
+    def remove(self, key):
+        """
+        Drop the lock of key, once no thread uses it. Its counters stay in `stats`.
+        """
+        with self.mutex:
+            if key not in self.locks:
+                return
+            if key in self.users:
+                self.removed.add(key)
+            else:
+                self.drop(key)
+
+    def drop(self, key):
+        """
+        Caller holds `mutex`.
+        """
+        self.removed.discard(key)
+        lock = self.locks.pop(key)
+        self.read_stats.merge(lock.read_stats)
+        self.write_stats.merge(lock.write_stats)
+
+    def stats(self):
+        """
+        :return: {"read": {...}, "write": {...}} summed over all locks, including dropped ones.
+        """
+        read = LockStats()
+        write = LockStats()
+        with self.mutex:
+            locks = list(self.locks.values())
+            read.merge(self.read_stats)
+            write.merge(self.write_stats)
+        for lock in locks:
+            read.merge(lock.read_stats)
+            write.merge(lock.write_stats)
+        return {"read": read.to_dict(), "write": write.to_dict()}
@@ -0,0 +1,257 @@
+"""
+Server metrics: request latency, time spent in each phase of request handling,
+network bytes and per-worker throughput. Lock contention is counted by the
+locks themselves, see `lock.LockStats`.
+
+Exposed with the "metrics" request method and in Prometheus text format.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of latency histogram buckets (sec).
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def exact(value) -> str:
+    """
+    Counter as a decimal string, for the "metrics" response. bcon ints must be below 2**32
+    and its floats are float32, so totals of a long-running server would come out wrong.
+    """
+    return str(value)
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, like a Prometheus histogram.
+    Not thread safe; Metrics holds its mutex while observing.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last: above all buckets
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding quantile q; inf if above all buckets.
+        """
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        return {
+            "count": exact(self.count),
+            "sum": exact(self.sum),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+    def prometheus(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class WorkerStats:
+    """
+    Throughput of one worker (render slot). Busy time is the sum of its frames' render times.
+    """
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.frames = 0
+        self.busy_time = 0
+
+    def fps(self):
+        elapsed = self.last_seen - self.first_seen
+        return self.frames / elapsed if elapsed > 0 else 0
+
+    def idle_ratio(self):
+        elapsed = max(self.last_seen - self.first_seen, self.busy_time)
+        return 1 - self.busy_time / elapsed if elapsed > 0 else 0
+
+    def to_dict(self):
+        return {
+            "frames": exact(self.frames),
+            "busy_time": exact(self.busy_time),
+            "fps": self.fps(),
+            "idle_ratio": self.idle_ratio(),
+        }
+
+
+class Metrics:
+    """
+    Counters of one server. All methods are thread safe.
+    """
+
+    # Forget workers not seen for this long (sec).
+    worker_expiry = 3600
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.started = time.time()
+        self.requests: dict[str, Histogram] = {}   # {method: latency}
+        self.phases: dict[str, Histogram] = {}   # {phase: time}, see `timed`
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.workers: dict[int, WorkerStats] = {}
+
+    def observe_request(self, method, seconds):
+        with self.mutex:
+            hist = self.requests.get(method)
+            if hist is None:
+                hist = self.requests[method] = Histogram()
+            hist.observe(seconds)
+
+    def observe_phase(self, phase, seconds):
+        with self.mutex:
+            hist = self.phases.get(phase)
+            if hist is None:
+                hist = self.phases[phase] = Histogram()
+            hist.observe(seconds)
+
+    @contextmanager
+    def timed(self, phase):
+        """
+        Time a block, e.g. "journal", "snapshot", "render_write", "send".
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - t)
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        with self.mutex:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def add_in_flight(self, delta):
+        with self.mutex:
+            self.in_flight += delta
+
+    def add_waiting(self, delta):
+        """
+        Long-poll requests being held.
+        """
+        with self.mutex:
+            self.waiting += delta
+
+    def worker_seen(self, worker_id):
+        now = time.time()
+        with self.mutex:
+            stats = self.workers.get(worker_id)
+            if stats is None:
+                stats = self.workers[worker_id] = WorkerStats(now)
+            stats.last_seen = now
+
+    def worker_frames(self, worker_id, frames, seconds):
+        """
+        :param seconds: Render time of the frames.
+        """
+        self.worker_seen(worker_id)
+        with self.mutex:
+            stats = self.workers[worker_id]
+            stats.frames += frames
+            stats.busy_time += seconds
+
+    def expire_workers(self):
+        """
+        Caller holds `mutex`.
+        """
+        now = time.time()
+        for worker_id in [worker_id for worker_id, stats in self.workers.items()
+                if now - stats.last_seen > self.worker_expiry]:
+            del self.workers[worker_id]
+
+    def to_dict(self, gauges=None):
+        """
+        :param gauges: Extra values, e.g. queue depth and lock stats from DataManager.
+        Counters and sums are decimal strings, see `exact`.
+        """
+        with self.mutex:
+            self.expire_workers()
+            return {
+                "uptime": exact(time.time() - self.started),
+                "requests": {method: hist.to_dict() for method, hist in self.requests.items()},
+                "phases": {phase: hist.to_dict() for phase, hist in self.phases.items()},
+                "bytes_in": exact(self.bytes_in),
+                "bytes_out": exact(self.bytes_out),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "workers": {worker_id: stats.to_dict() for worker_id, stats in self.workers.items()},
+                **(gauges or {}),
+            }
+
+    def prometheus(self, gauges=None, lock_stats=None):
+        """
+        Prometheus text exposition format.
+        :param gauges: {name: value}, exported as "brn_{name}".
+        :param lock_stats: {mode: LockStats.to_dict()}, see `LockRegistry.stats`.
+        """
+        lines = []
+        with self.mutex:
+            self.expire_workers()
+            lines.append("# TYPE brn_request_seconds histogram")
+            for method, hist in sorted(self.requests.items()):
+                lines.extend(hist.prometheus("brn_request_seconds", f'method="{method}"'))
+            lines.append("# TYPE brn_phase_seconds histogram")
+            for phase, hist in sorted(self.phases.items()):
+                lines.extend(hist.prometheus("brn_phase_seconds", f'phase="{phase}"'))
+
+            lines.append("# TYPE brn_bytes_total counter")
+            lines.append(f'brn_bytes_total{{direction="in"}} {self.bytes_in}')
+            lines.append(f'brn_bytes_total{{direction="out"}} {self.bytes_out}')
+            lines.append("# TYPE brn_requests_in_flight gauge")
+            lines.append(f"brn_requests_in_flight {self.in_flight}")
+            lines.append("# TYPE brn_requests_waiting gauge")
+            lines.append(f"brn_requests_waiting {self.waiting}")
+            lines.append("# TYPE brn_uptime_seconds gauge")
+            lines.append(f"brn_uptime_seconds {time.time() - self.started}")
+
+            for name, kind, get in (
+                    ("frames_total", "counter", lambda stats: stats.frames),
+                    ("busy_seconds_total", "counter", lambda stats: stats.busy_time),
+                    ("frames_per_second", "gauge", WorkerStats.fps),
+                    ("idle_ratio", "gauge", WorkerStats.idle_ratio)):
+                lines.append(f"# TYPE brn_worker_{name} {kind}")
+                for worker_id, stats in sorted(self.workers.items()):
+                    lines.append(f'brn_worker_{name}{{worker="{worker_id}"}} {get(stats)}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE brn_{name} gauge")
+            lines.append(f"brn_{name} {value}")
+
+        for key, name, kind in (
+                ("acquisitions", "brn_lock_acquisitions_total", "counter"),
+                ("contended", "brn_lock_contended_total", "counter"),
+                ("wait_time", "brn_lock_wait_seconds_total", "counter"),
+                ("max_wait", "brn_lock_max_wait_seconds", "gauge")):
+            lines.append(f"# TYPE {name} {kind}")
+            for mode, stats in (lock_stats or {}).items():
+                lines.append(f'{name}{{mode="{mode}"}} {stats[key]}')
+
+        return "\n".join(lines) + "\n"
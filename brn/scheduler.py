@@ -0,0 +1,200 @@
+"""
+Job schedulers: decide which pending job a worker gets next.
+"""
+
+import heapq
+import itertools
+
+
+class Scheduler:
+    """
+    Base class, ordering jobs by `key` (lowest first) on a lazily cleaned heap,
+    so picking a job is O(log jobs).
+
+    DataManager calls `add` when a job has frames to give out, `remove` when it
+    has none left, and `pick` then `claimed` in get_work. Calls are serialized
+    by the caller.
+
+    Cache affinity: among jobs of the same `level` as the best one, prefer the
+    job the worker rendered last (Blender host still has it loaded), then jobs
+    whose blend the worker has cached.
+
+    Job info keys used:
+    - "priority": Higher first. Default 0.
+    - "user": For fair share.
+    - "deadline": Unix time.
+    - "blend_hash": For cache affinity.
+    """
+
+    def __init__(self, affinity=True):
+        self.affinity = affinity
+        self.jobs = {}   # {job_id: info} of jobs with frames to give out
+        self.by_blend = {}   # {blend_hash: set(job_id)}
+        self.last_job = {}   # {worker_id: job_id}
+        self.heap = []   # [(key, job_id), ...]; may contain removed or outdated entries
+        self.seq = {}   # {job_id: order of first add}
+        self.counter = itertools.count()
+
+    def key(self, job_id):
+        return (-self.priority(job_id), self.seq[job_id])
+
+    def level(self, job_id):
+        """
+        Jobs of equal level may be swapped for cache affinity.
+        """
+        return self.priority(job_id)
+
+    def priority(self, job_id):
+        return self.jobs[job_id].get("priority", 0)
+
+    def add(self, job_id, info):
+        if job_id in self.jobs:
+            return
+        self.jobs[job_id] = info
+        self.seq.setdefault(job_id, next(self.counter))
+        self.by_blend.setdefault(info.get("blend_hash"), set()).add(job_id)
+        self.push(job_id)
+
+    def push(self, job_id):
+        heapq.heappush(self.heap, (self.key(job_id), job_id))
+
+    def remove(self, job_id):
+        info = self.jobs.pop(job_id, None)
+        if info is None:
+            return
+        jobs = self.by_blend[info.get("blend_hash")]
+        jobs.discard(job_id)
+        if not jobs:
+            del self.by_blend[info.get("blend_hash")]
+
+    def top(self, heap):
+        """
+        Best job in heap, dropping entries of removed jobs.
+        """
+        while heap:
+            key, job_id = heap[0]
+            if job_id in self.jobs and key == self.key(job_id):
+                return job_id
+            heapq.heappop(heap)
+        return None
+
+    def best(self):
+        return self.top(self.heap)
+
+    def pick(self, worker_id, blend_hashes=()):
+        """
+        :param blend_hashes: Blends the worker has cached.
+        :return: Job ID, or None if no job has frames to give out.
+        """
+        best = self.best()
+        if best is None or not self.affinity:
+            return best
+
+        level = self.level(best)
+        last = self.last_job.get(worker_id)
+        if last in self.jobs and self.level(last) == level:
+            return last
+        for blend_hash in blend_hashes:
+            for job_id in self.by_blend.get(blend_hash, ()):
+                if self.level(job_id) == level:
+                    return job_id
+        return best
+
+    def claimed(self, job_id, worker_id, count):
+        """
+        Worker claimed `count` frames of job.
+        """
+        self.last_job[worker_id] = job_id
+
+
+class PriorityScheduler(Scheduler):
+    """
+    Highest priority first, then oldest job first.
+    """
+
+
+class DeadlineScheduler(Scheduler):
+    """
+    Highest priority first, then earliest deadline first.
+    Jobs without a deadline go after those with one, oldest first.
+    """
+
+    def key(self, job_id):
+        deadline = self.jobs[job_id].get("deadline", float("inf"))
+        return (-self.priority(job_id), deadline, self.seq[job_id])
+
+
+class FairShareScheduler(Scheduler):
+    """
+    Gives the next batch to the user who was given the fewest frames so far;
+    within a user, highest priority then oldest job first.
+
+    A user who becomes active starts at the lowest usage among active users,
+    so time spent idle isn't saved up to starve everyone else later.
+    """
+
+    def __init__(self, affinity=True):
+        super().__init__(affinity)
+        self.usage = {}   # {user: frames claimed}
+        self.user_jobs = {}   # {user: number of jobs in `jobs`}
+        self.user_heap = []   # [(usage, user), ...]; lazily cleaned like `heap`
+        self.job_heaps = {}   # {user: [(key, job_id), ...]}, used instead of `heap`
+
+    def user(self, job_id):
+        return self.jobs[job_id].get("user", "")
+
+    def level(self, job_id):
+        return (self.user(job_id), self.priority(job_id))
+
+    def best_user(self):
+        while self.user_heap:
+            usage, user = self.user_heap[0]
+            if self.user_jobs.get(user) and usage == self.usage[user]:
+                return user
+            heapq.heappop(self.user_heap)
+        return None
+
+    def add(self, job_id, info):
+        if job_id in self.jobs:
+            return
+        user = info.get("user", "")
+        if not self.user_jobs.get(user):
+            min_user = self.best_user()
+            min_usage = 0 if min_user is None else self.usage[min_user]
+            self.usage[user] = max(self.usage.get(user, 0), min_usage)
+            heapq.heappush(self.user_heap, (self.usage[user], user))
+
+        self.user_jobs[user] = self.user_jobs.get(user, 0) + 1
+        super().add(job_id, info)
+
+    def push(self, job_id):
+        heapq.heappush(self.job_heaps.setdefault(self.user(job_id), []), (self.key(job_id), job_id))
+
+    def remove(self, job_id):
+        if job_id not in self.jobs:
+            return
+        user = self.user(job_id)
+        super().remove(job_id)
+        self.user_jobs[user] -= 1
+
+    def best(self):
+        user = self.best_user()
+        return None if user is None else self.top(self.job_heaps[user])
+
+    def claimed(self, job_id, worker_id, count):
+        super().claimed(job_id, worker_id, count)
+        if job_id in self.jobs:
+            user = self.user(job_id)
+            self.usage[user] += count
+            heapq.heappush(self.user_heap, (self.usage[user], user))
+
+
+SCHEDULERS = {
+    "priority": PriorityScheduler,
+    "deadline": DeadlineScheduler,
+    "fair": FairShareScheduler,
+}
+
+
+def make_scheduler(name="priority", affinity=True) -> Scheduler:
+    return SCHEDULERS[name](affinity)
@@ -1,14 +1,29 @@
-import pickle
+import io
 import random
+import tarfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from socket import socket, AF_INET, SOCK_STREAM
-from threading import Thread
+from socket import socket, AF_INET, SHUT_RD, SOCK_STREAM
+from threading import Lock, Thread
 
+from . import tiles
+from .chunkstore import valid_hash
 from .conn import *
 from .datamgr import DataManager
+from .frameset import FrameSet, decode, encode
+from .shard import Shards
+from .storage import FORMATS
 
-TMP_DIR = Path(f"/tmp/RenderFarmServer{random.randint(0, 100000)}")
-TMP_DIR.mkdir(exist_ok=True, parents=True)
+DEFAULT_ROOT = Path.home() / ".local" / "share" / "brn" / "server"
+
+
+def remove_temp_file(path):
+    """
+    Remove temporary file sent by a streamed response, and its checksum cache.
+    """
+    path.unlink(missing_ok=True)
+    path.with_name(path.name + ".crc").unlink(missing_ok=True)
 
 
 class Server:
@@ -17,43 +32,159 @@ class Server:
     If status == "ok", good request.
     Else, bad.
 
+    A connection may carry any number of requests, handled in order.
+    If a request contains "id", the response echoes it.
+
+    Lists of frames are sent as runs, e.g. [1, [10, 20], [100, 1000, 2]]; see `frameset.py`.
+    A plain list of frames is also accepted.
+
+    If the server runs as several processes (see `shard.py`), requests with a job_id are
+    forwarded to the process owning the job, with "forwarded"=True. A forwarded request is
+    always handled by the process it reaches; a file it would stream is returned as
+    file=[path, offset, temporary] for the forwarding process to stream.
+
     Request methods:
     - "worker_init":
-        - request: {}
+        - request: {name=None}
+            - name: Stable name of the worker, e.g. "host/0", kept across restarts; the ID is
+                only for this session. Render time estimates of a worker are kept by name.
         - response: {worker_id=...}
     - "download_blend":
-        - request: {job_id=...}
-        - response: {data=...}
+        - request: {job_id=..., stream=False, offset=0}
+        - response: {data=..., blend_hash=...}
+            - blend_hash: SHA-256 of the data, identical for identical uploads.
+            - If stream: {chunk_size=..., checksums=[...], size=...} followed by raw chunks from
+                chunk index `offset`, one per checksum. See `conn.download_file`.
+                size: File size in bytes, as a decimal string since it may not fit a bcon int.
     - "download_render":
-        - request: {job_id=..., frame=...}
-        - response: {data=...}
+        - request: {job_id=..., frame=..., stream=False, offset=0}
+        - response: {data=...}, or streamed like "download_blend".
     - "get_work":
-        - request: {worker_id=...}
-        - response: {job_id=..., frames=[...]}
+        - request: {worker_id=..., name=None, wait=0, blend_hashes=[]}
+            - name: Like "worker_init", so the server knows it after restarting.
+            - blend_hashes: Blends the worker has cached; the scheduler prefers their jobs.
+            - wait: If there is no work, hold the request until there is, for up to
+                this many seconds (capped at `max_wait`).
+            - speculate: Only between shards; whether a copy of a straggler may be returned.
+        - response: {job_id=..., frames=[...], blend_hash=..., format=...}, or status="no_work".
+            - format: Blender output format of the job.
+            - If the job is split into tiles: tiles=..., and frames are work units; see `tiles.py`.
+            - Near the end of a job, an idle worker may get a copy of a frame another worker
+                is late with. The first upload wins; see "status_update" for cancelling.
     - "upload_render":
         - request: {worker_id=..., job_id=..., frame=..., data=...}
         - response: {status="ok"}
+    - "upload_renders":
+        - request: {worker_id=..., job_id=..., renders={frame: data, ...}, times={frame: seconds, ...}}
+            - frame: Work unit if the job is split into tiles; data is then a PNG of the tile.
+            - times: Optional render time of each frame, for batch sizing.
+        - response: {status="ok"}
+    - "job_events":
+        - request: {job_id=..., cursor=0, wait=0}
+            - cursor: Number of completed frames already received; 0 to start.
+            - wait: If no frames completed since `cursor`, hold the request until one does,
+                for up to this many seconds (capped at `max_wait`).
+        - response: {frames=[...], cursor=..., finished=...}
+            - frames: Frames completed since `cursor`, in completion order.
+            - Pass the returned cursor in the next request.
+            - finished: True if all frames of the job are done.
+    - "download_renders":
+        - request: {job_id=..., cursor=0, wait=0, max_bytes=..., tar=False}
+            - cursor, wait: Like "job_events".
+        - response: {renders={frame: data, ...}, cursor=..., ext=..., finished=...}
+            - Frames completed since `cursor`, in completion order, up to about max_bytes
+                and, unless tar, at most `max_download_frames`.
+            - ext: File extension of the job's output format, e.g. "jpg".
+            - finished: True if all frames are done and included up to this response.
+            - If tar: {frames=[...], cursor=..., ext=..., finished=...} and the frames are streamed
+                as a tar archive like "download_blend", with files named "{frame}.{ext}".
     - "create_job":
-        - request: {blend=..., frames=[...], is_tar=...,}
+        - request: {blend=..., frames=[...], is_tar=..., priority=0, user="", deadline=..., tiles=1,
+                format="JPEG", packed=False}
+            - blend: Data of file. Alternatively, pass manifest=... whose chunks were sent
+                with "put_chunk" (is_tar is then ignored).
             - is_tar: True if uploaded a tar archive; false if a single blend file.
+            - priority, user, deadline (unix time): Optional, used by the scheduler.
+            - tiles: Optional, split each frame into this many tiles rendered separately.
+                Needs Pillow on the server and a format other than EXR, else status="tiles_unsupported".
+            - format: Optional output format, "JPEG" (default), "PNG" or "OPEN_EXR".
+            - packed: Optional, store renders in a few segment files instead of a file per frame.
         - response: {job_id=...}
+    - "missing_chunks":
+        - request: {hashes=[...]}
+        - response: {missing=[...]}
+            - missing: Hashes of chunks the server doesn't have yet.
+            - status="invalid_hash" if a hash isn't a lowercase hex SHA-256.
+    - "put_chunk":
+        - request: {hash=..., data=...}
+            - hash: SHA-256 of data; see `chunkstore`.
+        - response: {status="ok"}
     - "job_status":
         - request: {job_id=...}
         - response: {frames_done=..., frames_requested=...}
     - "status_update":
         - request: {job_id=..., frames=[...]}
-        - response: {status: "ok"}
+        - response: {status: "ok", cancel=[...]}
+            - cancel: Frames already completed by another worker; stop rendering them.
+    - "timing":
+        - request: {job_id=None}
+        - response: {workers={name: {n=..., mean=..., std=...}, ...}, job=...}
+            - Seconds per frame estimates used for batch sizing. workers: By name, see "worker_init".
+            - job: If job_id is given, {all={...}, workers={worker_id: {...}, ...}} for that job.
+    - "metrics":
+        - request: {prometheus=False}
+        - response: {metrics={...}}, see `Metrics.to_dict`; if prometheus: {text=...}
+            - Request latency per method, time per phase (journal, snapshot, render_write,
+                render_read, send, forward), bytes in and out, queue depth, lock contention, and
+                frames per second and idle ratio of each worker.
+            - Counters and sums (bytes, seconds, request counts) are decimal strings, as they
+                outgrow bcon's ints and float32.
+            - If sharded, only of the process handling the request, given as shard=...
+    - "work_available":
+        - Sent between shards when one has new work, to wake their waiting "get_work" requests.
+        - request: {}
+        - response: {status="ok"}
     """
 
-    def __init__(self, ip, port):
+    # Close connections idle for this long (sec).
+    idle_timeout = 300
+    # Default size limit of one "download_renders" response (bytes).
+    max_download_bytes = 64 * 2**20
+    # Frame limit of one "download_renders" response. bcon encodes a dict in time
+    # quadratic in its items, so many small frames are slow even below max_download_bytes.
+    max_download_frames = 16
+    # Max time a long-poll request is held (sec).
+    max_wait = 60
+    # Retry held requests at least this often (sec), e.g. to requeue timed out frames.
+    poll_interval = 5
+
+    def __init__(self, ip, port, scheduler=None, root=None, shard=None):
+        """
+        :param scheduler: See `DataManager`.
+        :param root: Data directory, kept across restarts. Default `DEFAULT_ROOT`.
+        :param shard: (index, count) if this is one of several processes serving
+            the same port and root, see `shard.py`.
+        """
         self.worker_ids = set()
+        # Open client connections, shut down by `stop`.
+        self.clients = set()
+        self.clients_lock = Lock()
+        self.stopped = False
 
-        self.manager = DataManager(TMP_DIR / "jobs")
+        self.root = Path(root) if root is not None else DEFAULT_ROOT
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.manager = DataManager(self.root / "jobs", scheduler=scheduler, shard=shard)
 
+        self.shards = None if shard is None else Shards(self.root, *shard)
         self.sock = socket(AF_INET, SOCK_STREAM)
+        self.peer_sock = None
+        if self.shards is not None:
+            self.shards.reuse_port(self.sock)
+            self.peer_sock = self.shards.peer_socket()
+            print(f"Shard {shard[0]} of {shard[1]}")
         self.sock.bind((ip, port))
 
-        print(f"Temporary directory: {TMP_DIR}")
+        print(f"Data directory: {self.root}")
         print(f"Binding to {ip}:{port}")
 
     def start(self):
@@ -61,105 +192,503 @@ class Server:
         Holds forever.
         """
         self.sock.listen()
+        if self.peer_sock is not None:
+            self.peer_sock.listen()
+            Thread(target=self.accept, args=(self.peer_sock,), daemon=True).start()
         print(f"Server listening")
+        self.accept(self.sock)
 
+    def accept(self, sock):
+        """
+        Serve each connection to `sock` on a new thread, until the socket is closed.
+        """
         while True:
-            client, addr = self.sock.accept()
+            try:
+                client, addr = sock.accept()
+            except OSError:
+                # Socket closed by `stop`.
+                break
             Thread(target=self.handle_client, args=(client, addr)).start()
 
     def stop(self):
         """
-        Stops the server.
+        Stops the server. Requests being handled finish, then their connections close,
+        including idle persistent ones.
         """
+        self.stopped = True
         self.sock.close()
+        if self.peer_sock is not None:
+            self.peer_sock.close()
+        with self.clients_lock:
+            clients = list(self.clients)
+        for conn in clients:
+            try:
+                # Wakes a handler waiting in recv, unlike close(), and still lets it send a response.
+                conn.shutdown(SHUT_RD)
+            except OSError:
+                pass
 
     def handle_client(self, conn, addr):
-        request = recv(conn)
-        if not isinstance(request, dict) or "method" not in request:
-            print(f"Invalid request from {addr}")
-            return
-        print(f"Request from {addr}; method={request['method']}")
+        """
+        Serve requests on one connection until the client closes it.
+        """
+        conn.settimeout(self.idle_timeout)
+        with self.clients_lock:
+            self.clients.add(conn)
+        try:
+            while not self.stopped:
+                try:
+                    request, size = recv_message(conn)
+                except (ConnectionError, OSError):
+                    break
+                self.manager.metrics.add_bytes(bytes_in=size)
+
+                if not isinstance(request, dict) or "method" not in request:
+                    print(f"Invalid request from {addr}")
+                    break
+                print(f"Request from {addr}; method={request['method']}")
+
+                response = self.respond(request, addr)
+                file = self.take_file(request, response)
+                if "id" in request:
+                    response["id"] = request["id"]
+                with self.manager.metrics.timed("send"):
+                    size = send(conn, response)
+                    if file is not None:
+                        path, offset, temporary = file
+                        try:
+                            size += send_file(conn, path, offset)
+                        finally:
+                            if temporary:
+                                remove_temp_file(path)
+                self.manager.metrics.add_bytes(bytes_out=size)
+        finally:
+            with self.clients_lock:
+                self.clients.discard(conn)
+            conn.close()
 
+    def respond(self, request, addr):
+        """
+        `handle_request`, repeated while a long-poll request has nothing to return yet.
+        Latency metrics count time spent handling, not waiting.
+        Requests for jobs of another shard are forwarded to it, which does the waiting.
+        """
+        shard = self.route(request)
+        if shard is not None:
+            return self.forward(shard, request)
+
+        metrics = self.manager.metrics
+        deadline = time.monotonic() + min(request.get("wait", 0), self.max_wait)
+        elapsed = 0
+        metrics.add_in_flight(1)
+        try:
+            while True:
+                t = time.perf_counter()
+                if request["method"] == "get_work":
+                    response = self.get_work(request, addr)
+                else:
+                    response = self.handle_request(request, addr)
+                if response.pop("_announce", False):
+                    self.announce_work()
+                elapsed += time.perf_counter() - t
+                wait = response.pop("_wait", None)
+                remaining = deadline - time.monotonic()
+                if wait is None or remaining <= 0 or self.stopped:
+                    metrics.observe_request(self.metric_name(request, response), elapsed)
+                    return response
+                if "_file" in response and response["_file"][2]:
+                    remove_temp_file(response["_file"][0])
+                notifier, version = wait
+                metrics.add_waiting(1)
+                try:
+                    notifier.wait(version, min(remaining, self.poll_interval))
+                finally:
+                    metrics.add_waiting(-1)
+        finally:
+            metrics.add_in_flight(-1)
+
+    def handle_request(self, request, addr):
+        """
+        Never blocks on long-poll requests: if there is nothing to return yet,
+        the response contains "_wait"=(notifier, version) to wait on before retrying.
+        :return: Response dict.
+        """
         if request["method"] == "worker_init":
-            while (worker_id := random.randint(0, 100000)) in self.worker_ids:
+            # Shards give out IDs equal to their index modulo the shard count, so they never collide.
+            stride, offset = (1, 0) if self.shards is None else (self.shards.count, self.shards.index)
+            while (worker_id := random.randint(0, 100000) * stride + offset) in self.worker_ids:
                 pass
-            send(conn, {"worker_id": worker_id})
             self.worker_ids.add(worker_id)
+            self.manager.name_worker(worker_id, request.get("name"))
+            response = {"status": "ok", "worker_id": worker_id}
 
         elif request["method"] == "download_blend":
-            path = self.manager.root / request["job_id"] / "blend.tar.gz"
-            if path.exists():
+            path = self.manager.blend_path(request["job_id"])
+            response = self.file_response(request, path)
+            if response["status"] == "ok":
+                response["blend_hash"] = self.manager.blend_hash(request["job_id"])
+
+        elif request["method"] == "download_render":
+            path, temporary = self.manager.render_file(request["job_id"], request["frame"])
+            response = self.file_response(request, path)
+            if temporary:
+                if "_file" in response:
+                    response["_file"] = (path, response["_file"][1], True)
+                else:
+                    remove_temp_file(path)
+
+        elif request["method"] == "get_work":
+            version = self.manager.work_notifier.version
+            worker_id = request["worker_id"]
+            self.manager.name_worker(worker_id, request.get("name"))
+            # One local step of `work_steps`. Forwarded requests are a step on the shard
+            # they were forwarded to.
+            if request.get("_step") == "speculate":
+                job_id, frames = self.manager.speculate(worker_id)
+            else:
+                speculate = request.get("forwarded", False) and request.get("speculate", False)
+                job_id, frames = self.manager.get_work(worker_id, request.get("blend_hashes", ()), speculate)
+
+            if job_id is None:
                 response = {
-                    "status": "ok",
-                    "data": path.read_bytes(),
+                    "status": "no_work",
+                    "_wait": (self.manager.work_notifier, version),
                 }
             else:
                 response = {
-                    "status": "not_found"
+                    "status": "ok",
+                    "job_id": job_id,
+                    "frames": encode(frames),
+                    "blend_hash": self.manager.blend_hash(job_id),
+                    "format": self.manager.job(job_id).info.get("format", "JPEG"),
                 }
-            send(conn, response)
+                tile_count = self.manager.job(job_id).tiles()
+                if tile_count > 1:
+                    response["tiles"] = tile_count
 
-        elif request["method"] == "download_render":
-            path = self.manager.root / request["job_id"] / "renders" / f"{request['frame']}.jpg"
-            if path.exists():
+        elif request["method"] == "upload_render":
+            if self.manager.save_render(request["worker_id"], request["job_id"], request["frame"], request["data"]):
+                response = {"status": "ok"}
+            else:
+                response = {"status": "not_found"}
+
+        elif request["method"] == "upload_renders":
+            if self.manager.save_renders(request["worker_id"], request["job_id"], request["renders"],
+                    request.get("times")):
+                response = {"status": "ok"}
+            else:
+                response = {"status": "not_found"}
+
+        elif request["method"] == "job_events":
+            events = self.manager.job_events(request["job_id"], request.get("cursor", 0))
+            if events is None:
+                response = {"status": "not_found"}
+            else:
+                frames, finished, version = events
                 response = {
                     "status": "ok",
-                    "data": path.read_bytes(),
+                    "frames": frames.encode(),
+                    "cursor": request.get("cursor", 0) + len(frames),
+                    "finished": finished,
                 }
+                if not frames and not finished:
+                    response["_wait"] = (self.manager.job_notifier(request["job_id"]), version)
+
+        elif request["method"] == "download_renders":
+            cursor = request.get("cursor", 0)
+            events = self.manager.job_events(request["job_id"], cursor)
+            if events is None:
+                response = {"status": "not_found"}
             else:
-                response = {
-                    "status": "not_found"
-                }
-            send(conn, response)
+                frames, finished, version = events
+                renders = self.manager.read_renders(request["job_id"], frames,
+                    request.get("max_bytes", self.max_download_bytes),
+                    None if request.get("tar", False) else self.max_download_frames)
+                ext = self.manager.store(request["job_id"]).ext
+                cursor += len(renders)
+                if request.get("tar", False):
+                    path = self.manager.temp_path(".tar")
+                    with tarfile.open(path, "w") as tar:
+                        for frame, data in renders.items():
+                            info = tarfile.TarInfo(f"{frame}.{ext}")
+                            info.size = len(data)
+                            tar.addfile(info, io.BytesIO(data))
+                    response = self.file_response({"stream": True}, path)
+                    response["_file"] = (path, 0, True)
+                    response["frames"] = encode(renders)
+                else:
+                    response = {
+                        "status": "ok",
+                        "renders": renders,
+                    }
+                response["cursor"] = cursor
+                response["ext"] = ext
+                response["finished"] = finished and len(renders) == len(frames)
+                if not frames and not finished:
+                    response["_wait"] = (self.manager.job_notifier(request["job_id"]), version)
 
-        elif request["method"] == "get_work":
-            job_id, frames = self.manager.get_work(request["worker_id"])
+        elif request["method"] == "create_job" and request.get("format", "JPEG") not in FORMATS:
+            response = {"status": "invalid_format"}
+
+        elif request["method"] == "create_job" and request.get("tiles", 1) > 1 and \
+                (not tiles.available() or request.get("format") == "OPEN_EXR"):
+            response = {"status": "tiles_unsupported"}
+
+        elif request["method"] == "create_job" and "manifest" in request:
+            job_id = self.manager.create_job_from_manifest(request["manifest"], FrameSet.decode(request["frames"]),
+                self.job_options(request))
             if job_id is None:
-                send(conn, {
-                    "status": "no_work",
-                })
+                response = {"status": "invalid_manifest"}
             else:
-                send(conn, {
+                response = {
                     "status": "ok",
                     "job_id": job_id,
-                    "frames": frames,
-                })
-
-        elif request["method"] == "upload_render":
-            self.manager.save_render(request["worker_id"], request["job_id"], request["frame"], request["data"])
-            send(conn, {"status": "ok"})
+                    "_announce": True,
+                }
 
         elif request["method"] == "create_job":
             job_id = self.manager.create_job(
                 request["blend"],
-                request["frames"],
+                FrameSet.decode(request["frames"]),
                 request["is_tar"],
+                self.job_options(request),
             )
-            send(conn, {
+            response = {
                 "status": "ok",
                 "job_id": job_id,
-            })
+                "_announce": True,
+            }
+
+        elif request["method"] == "missing_chunks" and not all(valid_hash(h) for h in request["hashes"]):
+            response = {"status": "invalid_hash"}
+
+        elif request["method"] == "missing_chunks":
+            response = {
+                "status": "ok",
+                "missing": self.manager.chunks.missing(request["hashes"]),
+            }
+
+        elif request["method"] == "put_chunk":
+            if self.manager.chunks.put(request["hash"], request["data"]):
+                response = {"status": "ok"}
+            else:
+                response = {"status": "checksum_mismatch"}
 
         elif request["method"] == "job_status":
-            path = self.manager.root / request["job_id"] / "status.pkl"
-            if path.exists():
-                data = pickle.loads(path.read_bytes())
-                all_frames = sorted(set(data["done"] + list(data["pending"].keys()) + data["todo"]))
+            status = self.manager.job_status(request["job_id"])
+            if status is not None:
+                frames_done, all_frames = status
                 response = {
                     "status": "ok",
-                    "frames_done": data["done"],
+                    "frames_done": frames_done,
                     "frames_requested": all_frames,
                 }
             else:
                 response = {
                     "status": "not_found"
                 }
-            send(conn, response)
 
         elif request["method"] == "status_update":
-            self.manager.status_update(request["job_id"], request["frames"])
-            send(conn, {"status": "ok"})
+            response = {
+                "status": "ok",
+                "cancel": self.manager.status_update(request["job_id"], list(decode(request["frames"]))),
+            }
+
+        elif request["method"] == "timing":
+            response = {"status": "ok", **self.manager.timing_info(request.get("job_id"))}
+
+        elif request["method"] == "metrics":
+            if request.get("prometheus", False):
+                response = {"status": "ok", "text": self.metrics_text()}
+            else:
+                response = {
+                    "status": "ok",
+                    "metrics": self.manager.metrics.to_dict({
+                        **self.manager.gauges(),
+                        "locks": self.manager.lock_stats(),
+                    }),
+                }
+                if self.shards is not None:
+                    response["shard"] = self.shards.index
+
+        elif request["method"] == "work_available":
+            self.manager.work_notifier.notify()
+            response = {"status": "ok"}
 
         else:
             print(f"Invalid method from {addr}")
-            send(conn, {"status": "invalid_request"})
+            response = {"status": "invalid_request"}
+
+        return response
+
+    def route(self, request):
+        """
+        :return: Index of the shard to forward request to, or None to handle it here.
+        """
+        if self.shards is None or request.get("forwarded", False):
+            return None
+        shard = self.shards.owner(request.get("job_id"))
+        return None if shard == self.shards.index else shard
+
+    def forward(self, shard, request):
+        """
+        Handle request on another shard. Files in the response are streamed by this
+        process, from the data directory both share.
+        """
+        try:
+            with self.manager.metrics.timed("forward"):
+                response = self.shards.request(shard, {**request, "forwarded": True})
+        except (ConnectionError, OSError):
+            print(f"Shard {shard} unavailable")
+            return {"status": "shard_unavailable"}
+
+        if "file" in response:
+            path, offset, temporary = response.pop("file")
+            response["_file"] = (Path(path.decode()), offset, temporary)
+        return response
+
+    def take_file(self, request, response):
+        """
+        Pop "_file" of a response. Forwarded requests get the file's path in the response instead.
+        :return: (path, offset, temporary) to stream after the response, or None.
+        """
+        file = response.pop("_file", None)
+        if file is not None and request.get("forwarded", False):
+            path, offset, temporary = file
+            # Bytes, since bcon miscounts the length of non-ASCII strings.
+            response["file"] = [str(path).encode(), offset, temporary]
+            return None
+        return file
+
+    def work_steps(self, request):
+        """
+        Steps of a "get_work" request, tried in order until one has work:
+        [(step, on other shards), ...], see `get_work`.
+        Frames not started on any shard come before copies of stragglers, see `DataManager.speculate`.
+        """
+        if request.get("forwarded", False):
+            return [("fresh", False)]
+        peers = (False, True) if self.shards is not None else (False,)
+        return [(step, peer) for step in ("fresh", "speculate") for peer in peers]
+
+    def get_work(self, request, addr):
+        """
+        Handle a "get_work" request through `work_steps`. Other shards are asked between
+        calls of `handle_request`, see `AsyncServer.get_work_async`.
+        """
+        response = wait = None
+        for step, peer in self.work_steps(request):
+            if peer:
+                response = self.peer_work(request, step == "speculate") or response
+            else:
+                response = self.handle_request({**request, "_step": step}, addr)
+                wait = wait or response.get("_wait")
+            if response["status"] != "no_work":
+                return response
+        # Notified since the first step counts.
+        response["_wait"] = wait
+        return response
+
+    def peer_work(self, request, speculate):
+        """
+        Work from other shards, for a "get_work" request this shard has no work for.
+        :param speculate: Ask for copies of stragglers instead of frames not started yet.
+        :return: Response of the first shard with work, or None.
+        """
+        if self.shards is None or request.get("forwarded", False):
+            return None
+        data = {
+            "method": "get_work",
+            "worker_id": request["worker_id"],
+            "name": request.get("name"),
+            "blend_hashes": request.get("blend_hashes", []),
+            "speculate": speculate,
+        }
+        for shard in self.shards.others():
+            response = self.forward(shard, data)
+            if response["status"] == "ok":
+                return response
+        return None
+
+    def announce_work(self):
+        """
+        Wake "get_work" requests waiting on other shards after creating a job.
+        """
+        if self.shards is None:
+            return
+        for shard in self.shards.others():
+            self.forward(shard, {"method": "work_available"})
+
+    @staticmethod
+    def metric_name(request, response):
+        """
+        Method label for latency metrics; unknown methods share one label.
+        """
+        if response["status"] == "invalid_request":
+            return "invalid"
+        return request["method"]
+
+    def metrics_text(self):
+        """
+        Metrics in Prometheus text format.
+        """
+        return self.manager.metrics.prometheus(self.manager.gauges(), self.manager.lock_stats())
+
+    def serve_metrics(self, port):
+        """
+        Serve `metrics_text` over HTTP at /metrics, for Prometheus to scrape.
+        Runs in a background thread.
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                data = server.metrics_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(("", port), Handler)
+        Thread(target=httpd.serve_forever, daemon=True).start()
+        print(f"Serving metrics on port {port}")
+
+    @staticmethod
+    def job_options(request):
+        """
+        Scheduling info of a "create_job" request.
+        """
+        keys = ("priority", "user", "deadline", "tiles", "format", "packed")
+        options = {key: request[key] for key in keys if key in request}
+        if options.get("tiles", 1) <= 1:
+            options.pop("tiles", None)
+        return options
+
+    def file_response(self, request, path):
+        """
+        Response for a file download, inline or streamed (see "download_blend").
+        """
+        if path is None or not path.exists():
+            return {"status": "not_found"}
+
+        if not request.get("stream", False):
+            return {
+                "status": "ok",
+                "data": path.read_bytes(),
+            }
+
+        offset = request.get("offset", 0)
+        return {
+            "status": "ok",
+            "chunk_size": CHUNK_SIZE,
+            "checksums": file_checksums(path)[offset:],
+            "size": str(path.stat().st_size),
+            "_file": (path, offset, False),
+        }
@@ -0,0 +1,137 @@
+"""
+Running the server as several processes ("shards") that share one port and data directory,
+so request handling isn't limited to one core by the GIL.
+
+Each shard owns the jobs whose ID is its index modulo the shard count: it allocates those IDs,
+keeps them in memory and is the only process that writes them, so shards don't need to lock
+against each other. The kernel spreads connections over the shards (SO_REUSEPORT). A request
+for a job of another shard is forwarded to that shard over a Unix socket in the data directory,
+so clients and workers see one server.
+"""
+
+import multiprocessing
+import random
+import signal
+import sys
+from pathlib import Path
+from socket import socket, SOL_SOCKET, SOCK_STREAM
+
+from . import interrupt
+from .conn import ConnectionPool, idempotent
+from .scheduler import make_scheduler
+
+try:
+    from socket import AF_UNIX, SO_REUSEPORT
+except ImportError:
+    AF_UNIX = SO_REUSEPORT = None
+
+
+def owner(job_id, count):
+    """
+    :return: Index of the shard owning job_id, or None if it isn't a valid job ID.
+    """
+    if not isinstance(job_id, str) or not job_id.isdigit() or len(job_id) > 18:
+        return None
+    return int(job_id) % count
+
+
+class Shards:
+    """
+    This process's place among the shards, and pooled connections to the others.
+    """
+
+    # Seconds to wait for another shard's response, longer than `Server.max_wait`
+    # so forwarded long polls finish; a shard stuck longer counts as unavailable.
+    timeout = 90
+
+    def __init__(self, root, index, count):
+        """
+        :param root: Data directory of the server.
+        """
+        if AF_UNIX is None or SO_REUSEPORT is None:
+            raise RuntimeError("Sharded server needs SO_REUSEPORT and Unix sockets.")
+        self.root = Path(root)
+        self.index = index
+        self.count = count
+        self.pool = ConnectionPool()
+
+    def path(self, index) -> Path:
+        """
+        Unix socket other shards reach shard `index` on.
+        """
+        return self.root / "shards" / f"{index}.sock"
+
+    def reuse_port(self, sock):
+        """
+        Let all shards bind the server port. Call before binding.
+        """
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+
+    def peer_socket(self):
+        """
+        :return: Socket bound to `path` of this shard, for requests from other shards.
+        """
+        path = self.path(self.index)
+        path.parent.mkdir(exist_ok=True)
+        # Left behind by a previous run.
+        path.unlink(missing_ok=True)
+        sock = socket(AF_UNIX, SOCK_STREAM)
+        sock.bind(str(path))
+        return sock
+
+    def owner(self, job_id):
+        """
+        :return: Index of the shard owning job_id, or None if it isn't a valid job ID.
+        """
+        return owner(job_id, self.count)
+
+    def others(self) -> list[int]:
+        """
+        Other shards, starting at a random one so requests spread evenly.
+        """
+        start = random.randrange(self.count)
+        return [i % self.count for i in range(start, start + self.count) if i % self.count != self.index]
+
+    def request(self, index, data):
+        """
+        Send request to shard `index` over a pooled connection.
+        """
+        return self.pool.run({"unix": str(self.path(index)), "timeout": self.timeout},
+            lambda conn: conn.request(data), idempotent(data))
+
+
+def run_shard(server_cls, ip, port, shard, scheduler, affinity, root, metrics_port):
+    """
+    Entry point of one shard process. Holds until the server stops.
+    :param shard: (index, count)
+    """
+    server = server_cls(ip, port, make_scheduler(scheduler, affinity), root, shard)
+    interrupt.register(server)
+    if metrics_port is not None:
+        server.serve_metrics(metrics_port + shard[0])
+    server.start()
+
+
+def serve(server_cls, ip, port, count, scheduler="priority", affinity=True, root=None, metrics_port=None):
+    """
+    Run the server as `count` shard processes. Holds until all of them stop (e.g. on Ctrl-C).
+    :param server_cls: Server or AsyncServer.
+    :param metrics_port: If given, shard i serves Prometheus metrics on metrics_port + i.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=run_shard, args=(server_cls, ip, port, (i, count), scheduler, affinity,
+        root, metrics_port)) for i in range(count)]
+    # Stop the shards too if this process is terminated.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs:
+            if proc.pid is not None:
+                proc.join()
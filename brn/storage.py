@@ -0,0 +1,193 @@
+"""
+Server-side storage of rendered frames.
+"""
+
+import shutil
+import struct
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from .conn import CHUNK_SIZE
+
+# Blender file format: file extension.
+FORMATS = {
+    "JPEG": "jpg",
+    "PNG": "png",
+    "OPEN_EXR": "exr",
+}
+
+
+class RenderStore(ABC):
+    """
+    Rendered frames of one job, in one image format.
+    Writes are serialized by the caller (job lock); reads may run concurrently with writes.
+    """
+
+    def __init__(self, root, ext):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ext = ext
+
+    @abstractmethod
+    def write(self, frame, data):
+        pass
+
+    @abstractmethod
+    def has(self, frame) -> bool:
+        pass
+
+    def read(self, frame) -> bytes:
+        with self.open(frame) as reader:
+            return reader.read()
+
+    @abstractmethod
+    def open(self, frame):
+        """
+        :return: File-like object reading only this frame's data.
+        """
+
+    def copy_to(self, frame, f):
+        """
+        Stream frame's data into file object f, CHUNK_SIZE at a time.
+        """
+        with self.open(frame) as reader:
+            shutil.copyfileobj(reader, f, CHUNK_SIZE)
+
+    def path(self, frame):
+        """
+        :return: Path of a file holding exactly this frame, or None if the store doesn't have one.
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+class FileStore(RenderStore):
+    """
+    One file per frame: root / "{frame}.{ext}".
+    Written under a temporary name first, so a crash never leaves a partial frame.
+    """
+
+    def path(self, frame):
+        return self.root / f"{frame}.{self.ext}"
+
+    def write(self, frame, data):
+        tmp_path = self.root / f"{frame}.{self.ext}.tmp"
+        tmp_path.write_bytes(data)
+        tmp_path.replace(self.path(frame))
+
+    def has(self, frame):
+        return self.path(frame).exists()
+
+    def open(self, frame):
+        return self.path(frame).open("rb")
+
+
+class SegmentReader:
+    """
+    File-like view of `length` bytes at `offset` of a file.
+    """
+
+    def __init__(self, path, offset, length):
+        self.file = open(path, "rb")
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PackedStore(RenderStore):
+    """
+    Frames appended to a few large segment files, for jobs with many frames.
+
+    File structure:
+    - root
+        - 0.pack, 1.pack, ...   # frame data, back to back
+        - index.bin   # INDEX_RECORD per frame written
+    A record is appended only after its data is flushed, so a torn record at
+    the end of the index (crash while writing) is ignored on load.
+    A frame written twice uses its last record.
+    """
+
+    INDEX_RECORD = struct.Struct("<qIQQ")   # frame, segment, offset, length
+    segment_size = 2**30
+
+    def __init__(self, root, ext):
+        super().__init__(root, ext)
+        self.index = {}   # {frame: (segment, offset, length)}
+        self.mutex = threading.Lock()
+        self.segment = 0
+        self.seg_file = None
+        self.index_file = None
+
+        index_path = self.root / "index.bin"
+        if index_path.exists():
+            data = index_path.read_bytes()
+            size = self.INDEX_RECORD.size
+            for i in range(0, len(data) - size + 1, size):
+                frame, segment, offset, length = self.INDEX_RECORD.unpack_from(data, i)
+                self.index[frame] = (segment, offset, length)
+                self.segment = max(self.segment, segment)
+            # Drop a torn record, so appends stay aligned.
+            if len(data) % size:
+                with index_path.open("r+b") as f:
+                    f.truncate(len(data) - len(data) % size)
+
+    def segment_path(self, segment):
+        return self.root / f"{segment}.pack"
+
+    def write(self, frame, data):
+        if self.seg_file is None:
+            self.seg_file = self.segment_path(self.segment).open("ab")
+            self.index_file = (self.root / "index.bin").open("ab")
+
+        offset = self.seg_file.tell()
+        if offset > 0 and offset + len(data) > self.segment_size:
+            self.seg_file.close()
+            self.segment += 1
+            self.seg_file = self.segment_path(self.segment).open("ab")
+            offset = self.seg_file.tell()
+
+        self.seg_file.write(data)
+        self.seg_file.flush()
+        self.index_file.write(self.INDEX_RECORD.pack(frame, self.segment, offset, len(data)))
+        self.index_file.flush()
+        with self.mutex:
+            self.index[frame] = (self.segment, offset, len(data))
+
+    def has(self, frame):
+        with self.mutex:
+            return frame in self.index
+
+    def open(self, frame):
+        with self.mutex:
+            segment, offset, length = self.index[frame]
+        return SegmentReader(self.segment_path(segment), offset, length)
+
+    def close(self):
+        for f in (self.seg_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.seg_file = None
+        self.index_file = None
+
+
+def make_store(root, format="JPEG", packed=False) -> RenderStore:
+    cls = PackedStore if packed else FileStore
+    return cls(root, FORMATS[format])
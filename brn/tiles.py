@@ -0,0 +1,62 @@
+"""
+Splitting frames into tiles, so one frame can be rendered by several workers.
+
+A job with `tiles` > 1 hands out work units instead of frames:
+    unit = frame * tiles + tile
+Tile `t` is the horizontal strip from `t / tiles` to `(t+1) / tiles` of the
+image height, counted from the bottom like Blender's render border.
+Tiles are rendered cropped to their border as PNG; the server pastes them
+back together (needs Pillow, installed with the "tiles" extra), so tiled jobs
+can't output EXR.
+"""
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+TILE_FORMAT = "PNG"
+
+
+def available():
+    return Image is not None
+
+
+def unit_frame(unit, tiles):
+    return unit // tiles
+
+
+def unit_tile(unit, tiles):
+    return unit % tiles
+
+
+def frame_units(frame, tiles):
+    return range(frame * tiles, (frame+1) * tiles)
+
+
+def tile_border(tile, tiles):
+    """
+    :return: [min_x, max_x, min_y, max_y] as fractions of the image.
+    """
+    return [0.0, 1.0, tile / tiles, (tile+1) / tiles]
+
+
+def assemble(tile_paths, f, format="JPEG"):
+    """
+    Paste tiles (bottom first) into one image.
+    :param f: File object to save to.
+    :param format: Output format, "JPEG" or "PNG".
+    """
+    images = [Image.open(path) for path in tile_paths]
+    width = max(image.width for image in images)
+    height = sum(image.height for image in images)
+
+    frame = Image.new("RGB", (width, height))
+    y = height
+    for image in images:
+        y -= image.height
+        frame.paste(image.convert("RGB"), (0, y))
+    if format == "JPEG":
+        frame.save(f, "JPEG", quality=90)
+    else:
+        frame.save(f, format)
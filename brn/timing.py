@@ -0,0 +1,94 @@
+"""
+Render time estimates used to size batches.
+"""
+
+import math
+import pickle
+import threading
+import time
+from pathlib import Path
+
+
+class Estimate:
+    """
+    Exponentially weighted mean and variance of seconds per frame.
+    """
+
+    alpha = 0.3
+
+    def __init__(self, n=0, mean=0.0, var=0.0):
+        self.n = n
+        self.mean = mean
+        self.var = var
+
+    def add(self, seconds):
+        if self.n == 0:
+            self.mean = seconds
+            self.var = 0.0
+        else:
+            diff = seconds - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.n += 1
+
+    def std(self):
+        return math.sqrt(self.var)
+
+    def to_tuple(self):
+        return (self.n, self.mean, self.var)
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "std": self.std()}
+
+
+class TimingModel:
+    """
+    Per-worker estimates over all jobs, for sizing a worker's first batch of a
+    job nobody has rendered yet. Per-(job, worker) estimates are in JobState.
+
+    Keyed by worker name (e.g. "host/0", see `worker.Slot`), which stays the same
+    across restarts of the worker and the server, unlike worker IDs.
+    Saved to `path` at most every `save_interval` seconds.
+    """
+
+    save_interval = 10
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.workers: dict[str, Estimate] = {}
+        self.last_save = 0
+        self.mutex = threading.Lock()
+
+        if self.path.exists():
+            data = pickle.loads(self.path.read_bytes())
+            # Older versions keyed by worker ID, which is random per worker session.
+            self.workers = {name: Estimate(*est) for name, est in data.items() if isinstance(name, str)}
+
+    def add(self, name, seconds):
+        """
+        :param name: Worker name; None for workers that didn't send one, which are not tracked.
+        """
+        if name is None:
+            return
+        with self.mutex:
+            self.workers.setdefault(name, Estimate()).add(seconds)
+            if time.time() - self.last_save > self.save_interval:
+                self.save()
+
+    def get(self, name) -> Estimate | None:
+        return self.workers.get(name)
+
+    def save(self):
+        """
+        Caller holds `mutex`.
+        """
+        self.last_save = time.time()
+        data = {name: est.to_tuple() for name, est in self.workers.items()}
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_bytes(pickle.dumps(data))
+        tmp_path.replace(self.path)
+
+    def to_dict(self):
+        with self.mutex:
+            return {name: est.to_dict() for name, est in self.workers.items()}
@@ -1,113 +1,589 @@
+import json
+import os
+import queue
 import random
 import shutil
-import tarfile
-import tempfile
 import time
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from subprocess import Popen, DEVNULL
+from socket import gethostname
+from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired
+from threading import Event, Lock, Thread
 
-from .conn import make_request
+from . import tiles
+from .cache import BlendCache
+from .conn import make_request, make_requests
+from .frameset import decode
 from .interrupt import interrupted
+from .storage import FORMATS
 
 TMP_DIR = Path(f"/tmp/RenderFarmWorker{random.randint(0, 100000)}")
-(TMP_DIR / "blends").mkdir(exist_ok=True, parents=True)
 (TMP_DIR / "renders").mkdir(exist_ok=True, parents=True)
 
 BLENDER = shutil.which("blender")
-assert BLENDER is not None, "Blender not found."
+# Used to pin Blender before it starts; preexec_fn isn't safe in a threaded process.
+TASKSET = shutil.which("taskset")
 
+HOST_SCRIPT = Path(__file__).parent / "blender_host.py"
 
-def ensure_blend(config, job_id):
-    path = TMP_DIR / "blends" / f"{job_id}"
-    if not path.exists():
-        print(f"  Downloading blend.tar.gz of job {job_id}...")
+# Seconds an idle slot's get_work request is held by the server.
+# Bounds how long an interrupt waits to be noticed.
+IDLE_WAIT = 10
 
-        resp = make_request(config, {"method": "download_blend", "job_id": job_id})
-        if resp["status"] != "ok":
-            raise Exception("Failed to download blend file.")
+# Seconds a slot waits after a failed assignment before asking for more work.
+ERROR_WAIT = 10
 
-        with tempfile.NamedTemporaryFile("wb") as tar:
-            tar.write(resp["data"])
-            with tarfile.open(tar.name) as tar:
-                tar.extractall(path)
 
-    return path / "main.blend"
+class RenderCancelled(Exception):
+    """
+    Raised by renderers when frames of the batch were completed by another worker.
+    """
+
+
+class Slot:
+    """
+    One render slot of a worker machine.
+    Each slot has its own worker ID (so the server sizes its batches separately),
+    Blender process and output directory. Slots share the blend cache.
+
+    The slot tracks every frame it has claimed but not uploaded yet (rendering,
+    prefetched or waiting for upload) and sends status updates for all of them.
+
+    :param threads: Blender render threads (0 = Blender's default).
+    :param cpus: CPU indices to pin Blender to, or None.
+    """
+
+    status_update_interval = 5
+
+    def __init__(self, index, threads=0, cpus=None):
+        self.index = index
+        self.threads = threads
+        self.cpus = cpus
+        self.worker_id = None
+        # Stable across restarts, unlike worker_id; keys the server's render time estimates.
+        self.name = f"{gethostname()}/{index}"
+        self.host = None
+        self.uploader = None
+        self.out_dir = TMP_DIR / "renders" / f"slot{index}"
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+
+        self.active = {}   # {job_id: set(frames)}
+        self.active_lock = Lock()
+        self.cancelled = set()   # {(job_id, frame)}
+        self.last_status_update = time.time()
+
+    def popen(self, args, **kwargs):
+        """
+        Start Blender with this slot's thread count and affinity.
+        """
+        cmd = [BLENDER, "-b", *args[:1]]
+        if self.threads > 0:
+            cmd += ["-t", str(self.threads)]
+        cmd += args[1:]
+        if self.cpus is not None and TASKSET is not None:
+            cmd = [TASKSET, "-c", ",".join(map(str, self.cpus)), *cmd]
+
+        proc = Popen(cmd, **kwargs)
+        if self.cpus is not None and TASKSET is None:
+            # Without taskset, only threads Blender starts after this are pinned.
+            try:
+                os.sched_setaffinity(proc.pid, self.cpus)
+            except ProcessLookupError:
+                # Already exited; the caller sees that from its exit status.
+                pass
+        return proc
+
+    def track(self, job_id, frames):
+        with self.active_lock:
+            self.active.setdefault(job_id, set()).update(frames)
+
+    def untrack(self, job_id, frame):
+        with self.active_lock:
+            frames = self.active.get(job_id)
+            if frames is not None:
+                frames.discard(frame)
+                if not frames:
+                    self.active.pop(job_id)
+
+    def untrack_all(self):
+        """
+        Stop status updates for all claimed frames, so the server requeues them.
+        """
+        with self.active_lock:
+            self.active.clear()
+
+    def is_cancelled(self, job_id, frame):
+        return (job_id, frame) in self.cancelled
+
+    def heartbeat(self, config):
+        """
+        Send status updates for all claimed frames, at most every `status_update_interval`.
+        Frames the server says were completed elsewhere are untracked and marked cancelled.
+        Safe to call from several threads.
+        """
+        with self.active_lock:
+            if time.time() - self.last_status_update < self.status_update_interval:
+                return
+            self.last_status_update = time.time()
+            active = [(job_id, sorted(frames)) for job_id, frames in self.active.items()]
+        if not active:
+            return
+        # One round trip for all jobs.
+        responses = make_requests(config, [{"method": "status_update", "job_id": job_id, "frames": frames}
+            for job_id, frames in active])
+        for (job_id, _), resp in zip(active, responses):
+            for frame in resp.get("cancel", []):
+                self.cancelled.add((job_id, frame))
+                self.untrack(job_id, frame)
+
+    @contextmanager
+    def heartbeats(self, config):
+        """
+        Keep sending `heartbeat`s from a background thread while the slot waits on
+        something else, e.g. a blend download, so claimed frames don't time out.
+        """
+        done = Event()
+        def run():
+            while not done.wait(1):
+                try:
+                    self.heartbeat(config)
+                except Exception as e:
+                    print(f"Slot {self.index}: Status update failed: {e}")
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.set()
+            thread.join()
+
 
+class Uploader:
+    """
+    Uploads frames in the background as soon as they are rendered.
+    Frames that queued up while an upload was running are sent together,
+    pipelined on one connection with one "upload_renders" request per frame;
+    bcon encodes a dict in time quadratic in its items, so big requests are slow.
+    """
+
+    # Max data per batch (bytes).
+    max_batch_bytes = 64 * 2**20
+
+    def __init__(self, config, slot):
+        self.config = config
+        self.slot = slot
+        self.queue = queue.Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, job_id, frame, path, seconds):
+        """
+        :param seconds: Render time of the frame.
+        """
+        self.queue.put((job_id, frame, path, seconds))
+
+    def run(self):
+        closed = False
+        while not closed:
+            items = [self.queue.get()]
+            size = 0
+            while items[-1] is not None and size < self.max_batch_bytes:
+                size += items[-1][2].stat().st_size
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is None:
+                closed = True
+                items.pop()
+
+            if items:
+                self.upload(items)
+
+    def upload(self, items):
+        """
+        :param items: [(job_id, frame, path, seconds), ...]
+        """
+        try:
+            make_requests(self.config, [{"method": "upload_renders", "job_id": job_id,
+                    "renders": {frame: path.read_bytes()}, "times": {frame: seconds},
+                    "worker_id": self.slot.worker_id} for job_id, frame, path, seconds in items])
+            for _, _, path, _ in items:
+                path.unlink()
+        except Exception as e:
+            # Server requeues the frames once status updates stop.
+            frames = [(job_id, frame) for job_id, frame, _, _ in items]
+            print(f"Slot {self.slot.index}: Failed to upload frames {frames}: {e}")
+        finally:
+            for job_id, frame, _, _ in items:
+                self.slot.untrack(job_id, frame)
+
+    def close(self):
+        """
+        Finish queued uploads and stop.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def run_blender_tiles(config, slot, job_id, file, units, on_frame, tile_count):
+    """
+    Render tiles, one Blender process each since each needs its own border.
+    """
+    print(f"  Running blender on {len(units)} tiles...")
+    for unit in units:
+        if slot.is_cancelled(job_id, unit):
+            continue
+        frame = tiles.unit_frame(unit, tile_count)
+        border = tiles.tile_border(tiles.unit_tile(unit, tile_count), tile_count)
+        expr = ("import bpy; r = bpy.context.scene.render; r.use_border = r.use_crop_to_border = True; "
+            f"r.border_min_x, r.border_max_x, r.border_min_y, r.border_max_y = {border}")
+        out_path = slot.out_dir / f"{job_id}_u{unit}_img"
+
+        proc = slot.popen(
+            [file, "--python-expr", expr, "-F", tiles.TILE_FORMAT, "-o", out_path, "-f", str(frame)],
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+            cwd=file.parent,
+        )
+        while proc.poll() is None:
+            time.sleep(0.1)
+            slot.heartbeat(config)
+            if slot.is_cancelled(job_id, unit):
+                proc.kill()
+                proc.wait()
+                raise RenderCancelled()
+
+        path = slot.out_dir / f"{job_id}_u{unit}_img{frame:04d}.png"
+        assert proc.returncode == 0 and path.exists(), "Blender failed to render."
+        on_frame(unit, path)
+
+
+def run_blender_render(config, slot, job_id, file, frames, on_frame, tile_count=1, format="JPEG"):
+    """
+    Render in a new Blender process.
+    Blender writes frames in order, so a frame is complete once the next
+    frame's file appears or the process exits.
+    :param on_frame: Called with (frame, path) as each frame finishes.
+    :param tile_count: If > 1, frames are work units, see `tiles.py`.
+    :param format: Blender file format, see `storage.FORMATS`.
+    """
+    if tile_count > 1:
+        run_blender_tiles(config, slot, job_id, file, frames, on_frame, tile_count)
+        return
 
-def run_blender_render(config, job_id, file, frames):
     print(f"  Running blender on {len(frames)} frames...")
-    out_path = TMP_DIR / "renders" / "img"
+    out_path = slot.out_dir / f"{job_id}_img"
 
-    proc = Popen(
-        [BLENDER, "-b", file, "-F", "JPEG", "-o", out_path, "-f", ",".join(map(str, frames))],
+    proc = slot.popen(
+        [file, "-F", format, "-o", out_path, "-f", ",".join(map(str, frames))],
         stdout=DEVNULL,
         stderr=DEVNULL,
         cwd=file.parent,
     )
 
-    last_status_update = time.time()
-    while proc.poll() is None:
+    paths = [slot.out_dir / f"{job_id}_img{frame:04d}.{FORMATS[format]}" for frame in frames]
+    num_done = 0
+    while num_done < len(frames):
+        running = proc.poll() is None
+        while num_done < len(frames):
+            if num_done + 1 < len(frames) and paths[num_done + 1].exists():
+                pass
+            elif not running and paths[num_done].exists():
+                pass
+            else:
+                break
+            on_frame(frames[num_done], paths[num_done])
+            num_done += 1
+
+        if not running:
+            break
         time.sleep(0.1)
-        if time.time() - last_status_update > 5:
-            make_request(config, {"method": "status_update", "job_id": job_id, "frames": frames})
-            last_status_update = time.time()
+        slot.heartbeat(config)
+        # Cancelled frames further on are dropped as they finish, see `render_work`.
+        if num_done < len(frames) and slot.is_cancelled(job_id, frames[num_done]):
+            proc.kill()
+            proc.wait()
+            raise RenderCancelled()
 
-    assert proc.returncode == 0, "Blender failed to render."
+    assert proc.returncode == 0 and num_done == len(frames), "Blender failed to render."
 
 
-def attempt_render(config, worker_id) -> bool:
+class BlenderHost:
     """
-    Attempt to render a job.
-    :return: True if a job was rendered, False otherwise.
+    Long-lived Blender process running `blender_host.py`.
+    Keeps one blend file loaded; restarted when a different file is rendered.
     """
-    time_start = time.time()
 
-    # Request work
-    resp = make_request(config, {"method": "get_work", "worker_id": worker_id})
+    def __init__(self, slot):
+        self.slot = slot
+        self.proc = None
+        self.file = None
+        self.messages = queue.Queue()
+
+    def start(self, file):
+        self.close()
+        print(f"  Starting blender host for {file}...")
+        self.file = file
+        self.messages = queue.Queue()
+        self.proc = self.slot.popen(
+            [file, "--python", HOST_SCRIPT],
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
+            cwd=file.parent,
+            text=True,
+        )
+        Thread(target=self.read_stdout, args=(self.proc, self.messages), daemon=True).start()
+
+    @staticmethod
+    def read_stdout(proc, messages):
+        """
+        Forward host messages to queue; drop Blender's own output.
+        None means the process exited.
+        """
+        prefix = "BRN_HOST "
+        for line in proc.stdout:
+            if line.startswith(prefix):
+                messages.put(json.loads(line[len(prefix):]))
+        messages.put(None)
+
+    def close(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.stdin.close()
+                try:
+                    self.proc.wait(10)
+                except TimeoutExpired:
+                    self.proc.kill()
+            self.proc = None
+            self.file = None
+
+    def render(self, config, job_id, file, frames, on_frame, tile_count=1, format="JPEG"):
+        """
+        Render frames, sending status updates while waiting.
+        Frames are rendered in order, so replies are matched to frames by position.
+        :param on_frame: Called with (frame, path) as each frame finishes.
+        :param tile_count: If > 1, frames are work units, see `tiles.py`.
+        :param format: Blender file format, see `storage.FORMATS`.
+        """
+        if self.proc is None or self.proc.poll() is not None or self.file != file:
+            self.start(file)
+
+        print(f"  Rendering {len(frames)} frames on blender host...")
+        for unit in frames:
+            if tile_count > 1:
+                request = {
+                    "frame": tiles.unit_frame(unit, tile_count),
+                    "path": str(self.slot.out_dir / f"{job_id}_u{unit}_img"),
+                    "format": tiles.TILE_FORMAT,
+                    "border": tiles.tile_border(tiles.unit_tile(unit, tile_count), tile_count),
+                }
+            else:
+                request = {"frame": unit, "path": str(self.slot.out_dir / f"{job_id}_img"), "format": format}
+            self.proc.stdin.write(json.dumps(request) + "\n")
+        self.proc.stdin.flush()
+
+        num_done = 0
+        while num_done < len(frames):
+            try:
+                msg = self.messages.get(timeout=0.1)
+            except queue.Empty:
+                msg = {}
+
+            if msg is None:
+                self.close()
+                raise Exception("Blender host exited.")
+            if "error" in msg:
+                self.close()
+                raise Exception(f"Blender failed to render frame {msg['frame']}: {msg['error']}")
+            if "file" in msg:
+                on_frame(frames[num_done], Path(msg["file"]))
+                num_done += 1
+
+            self.slot.heartbeat(config)
+            # Only restart the host if the frame it is rendering was cancelled.
+            # Cancelled frames further on are dropped as they finish, see `render_work`.
+            if num_done < len(frames) and self.slot.is_cancelled(job_id, frames[num_done]):
+                self.proc.kill()
+                self.close()
+                raise RenderCancelled()
+
+
+def fetch_work(config, slot, cache, wait=0):
+    """
+    Claim work from the server and make sure its blend is in the cache.
+    :param wait: Seconds the server may hold the request until work appears.
+    :return: get_work response, or None if there is no work.
+    """
+    resp = make_request(config, {"method": "get_work", "worker_id": slot.worker_id, "name": slot.name,
+        "wait": wait, "blend_hashes": cache.hashes()})
     if resp["status"] != "ok":
-        #print("No work.")
-        return False
-    job_id = resp["job_id"]
-    frames = resp["frames"]
-    print(f"Got work: job_id={job_id}, {len(frames)} frames.")
-
-    # Render
-    blend_path = ensure_blend(config, job_id)
-    run_blender_render(config, job_id, blend_path, frames)
-
-    # Upload result
-    print("  Uploading results...")
-    for frame in frames:
-        curr_path = TMP_DIR / "renders" / f"img{frame:04d}.jpg"
-        resp = make_request(config, {"method": "upload_render", "job_id": job_id, "frame": frame,
-                "data": curr_path.read_bytes(), "worker_id": worker_id})
+        return None
+    resp["frames"] = list(decode(resp["frames"]))
+    slot.track(resp["job_id"], resp["frames"])
+    with slot.heartbeats(config):
+        cache.prefetch(resp["job_id"], resp["blend_hash"])
+    return resp
+
+
+def render_work(config, slot, cache, work):
+    """
+    Render one assignment. Frames are uploaded in the background as they finish,
+    and the next assignment is fetched while the last frame renders.
+    :return: Next assignment (see `fetch_work`), or None.
+    """
+    time_start = time.time()
+    job_id = work["job_id"]
+    frames = work["frames"]
+    tile_count = work.get("tiles", 1)
+    format = work.get("format", "JPEG")
+    print(f"Slot {slot.index}: Got work: job_id={job_id}, {len(frames)} frames.")
+    remaining = list(frames)
+
+    prefetched = []
+    def prefetch():
+        try:
+            prefetched.append(fetch_work(config, slot, cache))
+        except Exception as e:
+            print(f"Slot {slot.index}: Prefetch failed: {e}")
+    prefetch_thread = Thread(target=prefetch)
+
+    def start_prefetch():
+        if not interrupted() and prefetch_thread.ident is None:
+            prefetch_thread.start()
+
+    num_done = 0
+    last_time = None
+    def on_frame(frame, path):
+        nonlocal num_done, last_time
+        now = time.time()
+        if slot.is_cancelled(job_id, frame):
+            # Rendered by another worker meanwhile, don't upload.
+            path.unlink(missing_ok=True)
+        else:
+            slot.uploader.put(job_id, frame, path, now - last_time)
+        last_time = now
+        remaining.remove(frame)
+        num_done += 1
+        if num_done == len(frames) - 1:
+            start_prefetch()
+
+    with ExitStack() as stack:
+        # Downloads the blend again if it was evicted since `fetch_work`.
+        with slot.heartbeats(config):
+            blend_path = stack.enter_context(cache.use(job_id, work["blend_hash"]))
+        # Frame times exclude the blend download.
+        last_time = time.time()
+        if len(frames) == 1:
+            start_prefetch()
+        while True:
+            cancelled = [frame for frame in remaining if slot.is_cancelled(job_id, frame)]
+            if cancelled:
+                print(f"  Cancelled frames {cancelled}, rendered by another worker.")
+                remaining = [frame for frame in remaining if frame not in cancelled]
+                if len(remaining) <= 1:
+                    start_prefetch()
+            if not remaining:
+                break
+            try:
+                if slot.host is not None:
+                    slot.host.render(config, job_id, blend_path, list(remaining), on_frame, tile_count, format)
+                else:
+                    run_blender_render(config, slot, job_id, blend_path, list(remaining), on_frame,
+                        tile_count, format)
+            except RenderCancelled:
+                last_time = time.time()
+
+    slot.cancelled.difference_update((job_id, frame) for frame in frames)
+    if prefetch_thread.ident is not None:
+        with slot.heartbeats(config):
+            prefetch_thread.join()
 
     time_elapse = time.time() - time_start
     sec_per_frame = time_elapse / len(frames)
     print(f"  Rendered {len(frames)} frames in {time_elapse:.2f} seconds ({sec_per_frame:.2f} sec/frame).")
 
-    print("  Done.")
-    return True
+    return prefetched[0] if prefetched else None
+
+
+def run_slot(config, slot, cache):
+    """
+    Work loop of one slot.
+    If the slot is idle, the server holds its get_work request until work appears.
+    """
+    resp = make_request(config, {"method": "worker_init", "name": slot.name})
+    slot.worker_id = resp["worker_id"]
+    print(f"Slot {slot.index}: worker ID is {slot.worker_id}")
+    if config.get("persistent_blender", True):
+        slot.host = BlenderHost(slot)
+    slot.uploader = Uploader(config, slot)
+
+    work = None
+    try:
+        while not interrupted():
+            try:
+                if work is None:
+                    work = fetch_work(config, slot, cache, wait=IDLE_WAIT)
+                if work is not None:
+                    work = render_work(config, slot, cache, work)
+            except Exception as e:
+                print(f"Slot {slot.index}: Work failed: {e!r}; retrying in {ERROR_WAIT} seconds.")
+                # Start over with a fresh host; unfinished frames are requeued by the server.
+                if slot.host is not None:
+                    slot.host.close()
+                slot.untrack_all()
+                slot.cancelled.clear()
+                work = None
+                time.sleep(ERROR_WAIT)
+    finally:
+        if slot.host is not None:
+            slot.host.close()
+        slot.uploader.close()
 
 
-def run_worker(config):
+def make_slots(num_slots=1, threads=0, pin=False):
     """
-    Run the worker loop.
-    If the worker is idle, it will sleep for a bit before trying again.
+    :param threads: Render threads per slot; 0 = Blender default, or an even share of CPUs if pinned.
+    :param pin: Pin each slot to its own range of CPUs.
     """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if pin and threads <= 0:
+        threads = max(1, len(cpus) // num_slots)
+
+    if pin and threads * num_slots > len(cpus):
+        print(f"Warning: {num_slots} slots of {threads} threads share {len(cpus)} CPUs.")
+
+    slots = []
+    for i in range(num_slots):
+        slot_cpus = None
+        if pin:
+            # Wraps around if there are fewer CPUs than threads, so every slot is pinned.
+            slot_cpus = sorted({cpus[j % len(cpus)] for j in range(i*threads, (i+1)*threads)})
+        slots.append(Slot(i, threads, slot_cpus))
+    return slots
+
+
+def run_worker(config, num_slots=1, threads=0, pin=False):
+    """
+    Run the worker loop on each slot.
+
+    Config keys:
+    - "persistent_blender": Keep Blender running between batches (default True).
+    """
+    assert BLENDER is not None, "Blender not found."
     print("Worker starting.")
     print(f"Temporary directory: {TMP_DIR}")
-    print("Initializing worker...")
-    resp = make_request(config, {"method": "worker_init"})
-    worker_id = resp["worker_id"]
-    print(f"Worker ID is {worker_id}")
+    cache = BlendCache(config)
+    print(f"Blend cache: {cache.root}")
+
+    slots = make_slots(num_slots, threads, pin)
+    for slot in slots:
+        print(f"Slot {slot.index}: threads={slot.threads or 'auto'}, cpus={slot.cpus or 'all'}")
     print("Waiting for work")
 
-    delay = 0
-    while not interrupted():
-        did_work = attempt_render(config, worker_id)
-        if did_work:
-            delay = 0
-        else:
-            delay = min(delay + 1, 10)
-        time.sleep(delay)
+    threads = [Thread(target=run_slot, args=(config, slot, cache)) for slot in slots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
@@ -17,6 +17,10 @@ setuptools.setup(
     install_requires=[
         "bcon",
     ],
+    extras_require={
+        # Assembling tiles on the server.
+        "tiles": ["Pillow"],
+    },
     entry_points={
         "console_scripts": [
             "brn=brn.__main__:main",